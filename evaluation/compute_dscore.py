@@ -8,38 +8,333 @@ import pickle
 import cv2
 import numpy as np
 import os, sys, time
+import torch
 from statistics import median
 
 current_dir   = os.path.dirname(os.path.abspath(__file__))
 training_dir  = os.path.join(current_dir, '..', 'training')
 sys.path.insert(0, os.path.abspath(training_dir))
 
-def load_detectors(pkl_path: str):
+from detectors import (SharedPreprocessor, predict_frames, quantize_detector, default_quant_mode,
+                       calibration_frames, calib_hash)
+from score_cache import ScoreCache, read_frames, decode_frame
+from frame_loader import PrefetchLoader
+
+def load_detectors(path: str, verify: bool = False):
+    """ detectors.json（レジストリ）または旧形式の detectors.pkl を読み込む """
     t0 = time.perf_counter()
-    detectors = pickle.load(open(pkl_path, "rb"))
+    if path.endswith(".json"):
+        from detector_registry import load_registry
+        detectors = load_registry(path, verify=verify)
+    else:
+        detectors = pickle.load(open(path, "rb"))
+        for det in detectors:
+            # 旧バージョンで保存した detectors.pkl は input_size を持たないので CenterCrop から復元
+            if not hasattr(det, "input_size"):
+                det.input_size = det.transform.transforms[1].size[0]
+            det.name = getattr(det, "name", type(det).__name__)
+            det.weight_hash = getattr(det, "weight_hash", None)
     print(f"[D-Score] Loaded {len(detectors)} detectors in {time.perf_counter()-t0:.2f}s")
     return detectors
 
+def quantize_detectors(detectors, frame_paths, n_calib=64, batch_size=16):
+    """
+    各検出器を int8 化（静的量子化の較正には frame_paths から等間隔に選んだフレームを使う）。
+    frame_paths は候補によらない固定のセット（実写フレーム or --calib）なので、
+    生成動画を替えても int8 モデルと実写側のスコアは変わらない。
+    """
+    t0 = time.perf_counter()
+    blobs, _ = read_frames(calibration_frames(frame_paths, n_calib))
+    imgs = [decode_frame(b) for b in blobs]
+    calib_id = calib_hash(blobs)
+    for det in detectors:
+        mode = default_quant_mode(det)
+        calib = None
+        if mode == "static":
+            pre = SharedPreprocessor([det.input_size])
+            calib = [pre(imgs[i:i+batch_size])[det.input_size].clone()
+                     for i in range(0, len(imgs), batch_size)]
+        # static では較正セットのハッシュが det.calib_hash に入り、スコアキャッシュのキーに使われる
+        quantize_detector(det, calib, mode, calib_id)
+        suffix = f", calibration {len(blobs)} frames {calib_id[:12]}" if mode == "static" else ""
+        print(f"[D-Score] Quantized {det.name} ({mode} int8{suffix})")
+    print(f"[D-Score] Quantization done in {time.perf_counter()-t0:.2f}s")
+
 def list_frames(dir: str):
     paths = sorted(glob.glob(dir))
     print(f"[Frames] {dir} -> {len(paths)} frames")
     return paths
 
-def infer_prob_real(detectors, frame_paths):
+def prepare_batch(paths, cache=None):
+    """
+    ローダーのワーカースレッドで実行する段:
+    ファイル読み込み → スコアキャッシュ照合 → 未キャッシュのフレームだけデコードして RGB uint8 に積む
+    """
+    if cache is None:
+        imgs = [cv2.imread(fn) for fn in paths]  # BGR
+        return dict(probs=None, batch=SharedPreprocessor.prepare(imgs))
+
+    blobs, keys = read_frames(paths)
+    probs = cache.lookup(keys)
+    missing = np.isnan(probs)
+    rows = np.nonzero(missing.any(axis=1))[0]
+    batch = SharedPreprocessor.prepare([decode_frame(blobs[i]) for i in rows]) if len(rows) else None
+    return dict(probs=probs, batch=batch, keys=keys, missing=missing, rows=rows)
+
+def score_batch(detectors, preprocessor, prep, cache=None):
+    """ メインスレッドで実行する段: テンソル前処理・推論・キャッシュ書き込み。各フレームの P(real) 平均を返す """
+    if prep["probs"] is None:
+        return predict_frames(detectors, prep["batch"], preprocessor, prepared=True).mean(axis=1)  # 各detectorのP(real)を平均
+
+    # キャッシュにあるスコアは再利用し、足りないフレーム・検出器だけ推論する
+    probs, missing, rows = prep["probs"], prep["missing"], prep["rows"]
+    if len(rows):
+        inputs = preprocessor(prep["batch"], prepared=True)
+        for j, det in enumerate(detectors):
+            need = missing[rows, j]
+            if need.any():
+                x = inputs[det.input_size]
+                if not need.all():
+                    x = x[torch.from_numpy(np.nonzero(need)[0]).to(x.device)]
+                probs[rows[need], j] = det.predict_batch(x)
+        cache.store(prep["keys"], probs, missing)
+    return probs.mean(axis=1)
+
+def make_loader(paths, batch_size, cache=None, workers=4, prefetch=8):
+    """ paths を batch_size ごとに区切り、デコードをスレッドで先読みするローダーを返す """
+    batches = (paths[i:i+batch_size] for i in range(0, len(paths), batch_size))
+    return PrefetchLoader(batches, lambda b: prepare_batch(b, cache), workers, prefetch)
+
+def infer_prob_real(detectors, frame_paths, batch_size=16, cache=None, workers=4, prefetch=8, name="frames",
+                    progress=True):
     """各フレームについて、全検出器の P(real) を平均して返す（1D配列）"""
+    # 前処理は全検出器で共有し、バッチ単位で一度だけ行う
+    preprocessor = SharedPreprocessor([det.input_size for det in detectors])
     probs = []
     t0 = time.perf_counter()
     total = len(frame_paths)
-    for i, fn in enumerate(frame_paths, 1):
-        img = cv2.imread(fn)  # BGR
-        p = np.mean([det.predict(img) for det in detectors])  # 各detectorのP(real)を平均
-        probs.append(p)
-        if i % 50 == 0 or i == total:
+    hits0, misses0 = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    loader = make_loader(frame_paths, batch_size, cache, workers, prefetch)
+    for prep in loader:
+        probs.extend(score_batch(detectors, preprocessor, prep, cache))
+        if progress:
+            i = len(probs)
             dt = time.perf_counter() - t0
             print(f"[Infer] {i}/{total} frames  avg {dt/max(1,i):.3f}s/frame", end='\r', flush=True)
-    print()
+    if progress:
+        print()
+    loader.report(name)
+    if cache is not None:
+        # 系列ごとの内訳（実写側が候補をまたいで再利用されているかの確認用）
+        print(f"[Cache] {name}: {cache.hits - hits0} hits / {cache.misses - misses0} misses")
     return np.asarray(probs, dtype=np.float32)
 
+class RunningStats:
+    """ Welford 法による逐次平均・分散 """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        for v in np.asarray(values, dtype=np.float64):
+            self.n += 1
+            delta = v - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (v - self.mean)
+
+    @property
+    def var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else float('nan')
+
+    def half_width(self, z, population):
+        """ 平均の信頼区間の半幅（非復元抽出なので有限母集団修正を掛ける） """
+        if self.n < 2:
+            return float('inf')
+        fpc = np.sqrt((population - self.n) / (population - 1)) if population > 1 else 0.0
+        return z * np.sqrt(self.var / self.n) * fpc
+
+def cohens_d_stats(sx, sy):
+    """ RunningStats 2つから Cohen's d とその標準誤差を返す """
+    nx, ny = sx.n, sy.n
+    if nx < 2 or ny < 2: return float('nan'), float('nan')
+    sp = np.sqrt(((nx-1)*sx.var + (ny-1)*sy.var) / (nx+ny-2))
+    d = 0.0 if sp == 0 else (sx.mean - sy.mean) / sp
+    se = np.sqrt((nx+ny)/(nx*ny) + d*d/(2*(nx+ny)))
+    return d, se
+
+def stratified_order(n, n_strata, rng):
+    """
+    フレームを n_strata 個の連続区間に分け、各ラウンドで全区間から1枚ずつ
+    ランダムに引く順序を返す（どこで打ち切っても動画全体から均等に抽出される）
+    """
+    strata = [rng.permutation(b) for b in np.array_split(np.arange(n), n_strata)]
+    order = []
+    for r in range(max(len(b) for b in strata)):
+        picks = [b[r] for b in strata if r < len(b)]
+        order.extend(rng.permutation(picks))
+    return np.asarray(order, dtype=int)
+
+def infer_prob_real_sequential(detectors, paths_by_name, batch_size=16, tol=0.01,
+                               max_frames=None, min_frames=32, z=1.96, seed=0, cache=None,
+                               workers=4, prefetch=8):
+    """
+    層化ランダム順にフレームを採点し、平均 P(real) の信頼区間半幅が tol 以下、
+    またはフレーム予算 max_frames に達した系列から打ち切る。
+    return: {name: 採点したフレームの P(real) 配列}, {name: RunningStats}
+    """
+    preprocessor = SharedPreprocessor([det.input_size for det in detectors])
+    rng = np.random.default_rng(seed)
+    streams = {}
+    for name, paths in paths_by_name.items():
+        if not paths: continue
+        order = stratified_order(len(paths), min(len(paths), 64), rng)
+        budget = len(paths) if max_frames is None else min(len(paths), max_frames)
+        ordered = [paths[i] for i in order[:budget]]
+        streams[name] = dict(paths=paths, loader=make_loader(ordered, batch_size, cache, workers, prefetch),
+                             stats=RunningStats(), probs=[])
+
+    t0 = time.perf_counter()
+    active = list(streams)
+    while active:
+        for name in list(active):
+            st = streams[name]
+            prep = next(st["loader"], None)
+            if prep is not None:
+                p = score_batch(detectors, preprocessor, prep, cache)
+                st["probs"].extend(p)
+                st["stats"].update(p)
+            hw = st["stats"].half_width(z, len(st["paths"]))
+            if prep is None or (st["stats"].n >= min_frames and hw <= tol):
+                # 打ち切った系列の先読み分は破棄する
+                st["loader"].close()
+                active.remove(name)
+        status = "  ".join(f"{name}: n={st['stats'].n} mean={st['stats'].mean:.4f}"
+                           f"±{st['stats'].half_width(z, len(st['paths'])):.4f}"
+                           for name, st in streams.items())
+        print(f"[Sample] {status}  ({time.perf_counter()-t0:.1f}s)", end='\r', flush=True)
+    print()
+    for name, st in streams.items():
+        st["loader"].report(name)
+    probs = {name: np.asarray(st["probs"], dtype=np.float32) for name, st in streams.items()}
+    stats = {name: st["stats"] for name, st in streams.items()}
+    return probs, stats
+
+def setup_scoring(cfg, calib_paths):
+    """ 検出器のロード・バックエンド設定・量子化・スコアキャッシュ準備（cfg は argparse の vars） """
+    detectors = load_detectors(cfg["detectors"], cfg["verify_weights"])
+    if cfg["backend"] != "eager":
+        t0 = time.perf_counter()
+        for det in detectors:
+            det.set_backend(cfg["backend"], cfg["compile_cache"], cfg["batch_size"])
+        print(f"[D-Score] Backend {cfg['backend']} ready in {time.perf_counter()-t0:.2f}s")
+    if cfg["quantize"]:
+        quantize_detectors(detectors, calib_paths, cfg["calib_frames"], cfg["batch_size"])
+    cache = None if cfg["no_score_cache"] else ScoreCache(cfg["score_cache"], detectors)
+    return detectors, cache
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS / Windows
+        return os.cpu_count() or 1
+
+def default_shard_split(cores):
+    """ コア数から (ワーカー数, ワーカーあたりの torch スレッド数) を決める """
+    threads = 4 if cores >= 8 else max(1, cores // 2)
+    return max(1, cores // threads), threads
+
+# シャードワーカーのプロセス内状態（initializer で1回だけ検出器をロードする）
+_SHARD = {}
+
+def _init_shard_worker(cfg, calib_paths, n_threads):
+    """
+    ワーカーの初期化。ここで例外を出すと Pool がワーカーを作り直し続けるので、
+    エラーは _SHARD["error"] に残して最初のタスクで親へ返す。
+    """
+    from multiprocessing.util import Finalize
+    # 各ワーカーの intra-op スレッド数を固定してコアの奪い合いを防ぐ
+    # （OMP/MKL の環境変数は torch の import 前に効く必要があるので、親プロセスで設定して継承させる）
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:  # 既に並列処理が始まっている場合は変更できない
+        pass
+    cv2.setNumThreads(1)
+    _SHARD["cfg"] = cfg
+    try:
+        _SHARD["detectors"], _SHARD["cache"] = setup_scoring(cfg, calib_paths)
+    except Exception as e:
+        _SHARD["error"] = f"{type(e).__name__}: {e}"
+        return
+    if _SHARD["cache"] is not None:
+        # ワーカー終了時（pool.close() → join()）に SQLite 接続を閉じる
+        Finalize(_SHARD["cache"], _SHARD["cache"].close, exitpriority=10)
+
+def _score_shard(task):
+    """ return: (P(real) 配列, キャッシュヒット数, ミス数, pid) """
+    if "error" in _SHARD:
+        raise RuntimeError(f"Shard worker setup failed: {_SHARD['error']}")
+    name, paths = task
+    cfg, cache = _SHARD["cfg"], _SHARD["cache"]
+    hits0, misses0 = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    probs = infer_prob_real(_SHARD["detectors"], paths, cfg["batch_size"], cache,
+                            cfg["decode_workers"], cfg["prefetch"], name=f"{name}[pid {os.getpid()}]",
+                            progress=False)
+    if cache is None:
+        return probs, 0, 0, os.getpid()
+    return probs, cache.hits - hits0, cache.misses - misses0, os.getpid()
+
+def infer_prob_real_sharded(cfg, paths_by_name, shards, threads, calib_paths):
+    """
+    フレーム列を連続区間に分けて shards 個のプロセスで並列に採点し、元の順序で連結する。
+    return: {name: P(real) 配列}
+    """
+    import multiprocessing as mp
+    tasks, owners = [], []
+    for name, paths in paths_by_name.items():
+        for part in np.array_split(np.arange(len(paths)), min(shards, max(1, len(paths)))):
+            if len(part):
+                tasks.append((name, [paths[i] for i in part]))
+                owners.append(name)
+    print(f"[Shard] {shards} workers x {threads} threads, {len(tasks)} shards")
+    t0 = time.perf_counter()
+    # spawn したワーカーは起動時の環境変数を引き継ぎ、その後で torch を import する。
+    # プール生成の間だけ親の環境変数を書き換え、ワーカーの OpenMP/MKL スレッド数を固定する
+    thread_vars = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+    saved = {var: os.environ.get(var) for var in thread_vars}
+    os.environ.update({var: str(threads) for var in thread_vars})
+    try:
+        # fork 後の torch スレッドプールはデッドロックしうるので spawn を使う
+        pool = mp.get_context("spawn").Pool(shards, initializer=_init_shard_worker,
+                                            initargs=(cfg, calib_paths, threads))
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    try:
+        results = pool.map(_score_shard, tasks, chunksize=1)
+        # terminate() ではなく close() → join() でワーカーを正常終了させ、スコアキャッシュを閉じさせる
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print(f"[Shard] Done in {time.perf_counter()-t0:.1f}s")
+    if not cfg["no_score_cache"]:
+        for (name, paths), (_, hits, misses, pid) in zip(tasks, results):
+            print(f"[Cache] shard {name}[pid {pid}] {len(paths)} frames: {hits} hits / {misses} misses")
+        print(f"[Cache] {sum(r[1] for r in results)} hits / {sum(r[2] for r in results)} misses "
+              f"({cfg['score_cache']})")
+    out = {}
+    for name in paths_by_name:
+        parts = [r[0] for r, o in zip(results, owners) if o == name]
+        out[name] = np.concatenate(parts).astype(np.float32) if parts else np.array([], dtype=np.float32)
+    return out
+
 def summarize(name, arr):
     arr = np.asarray(arr, dtype=np.float32)
     summary = {
@@ -68,12 +363,45 @@ def cohens_d(x, y):
 
 def main():
     ap = argparse.ArgumentParser(description="Compute D-Score for real and gen, compare in terminal")
-    ap.add_argument("--detectors", default="detectors.pkl", help="Path to detectors.pkl")
+    ap.add_argument("--detectors", default="detectors.json",
+                    help="Detector registry (detectors.json) or legacy detectors.pkl")
+    ap.add_argument("--fast", action="store_true",
+                    help="Use the distilled single-backbone student (--fast-detectors) for a quick screen")
+    ap.add_argument("--fast-detectors", default="detectors_fast.json",
+                    help="Student registry written by training/distill_detectors.py")
+    ap.add_argument("--verify-weights", action="store_true", help="Verify sha256 of registry weights")
+    ap.add_argument("--backend", default="eager", choices=["eager", "torchscript", "compile", "onnx"],
+                    help="Inference backend (compiled artifacts are cached per weight hash)")
+    ap.add_argument("--compile-cache", default=None, help="Cache directory for compiled backends")
     ap.add_argument("--real", default="frames/aligned/real/*.png", help="Glob for real frames")
     ap.add_argument("--gen",  default="frames/aligned/gen/*.png",  help="Glob for gen frames")
+    ap.add_argument("--batch-size", type=int, default=16, help="Frames per inference batch")
+    ap.add_argument("--score-cache", default="dscore_cache.sqlite",
+                    help="SQLite cache of per-frame detector scores (keyed by frame content + weights)")
+    ap.add_argument("--no-score-cache", action="store_true", help="Disable the score cache")
+    ap.add_argument("--decode-workers", type=int, default=4, help="Threads decoding frames ahead of inference")
+    ap.add_argument("--prefetch", type=int, default=8, help="Max decoded batches kept ready (bounds memory)")
+    ap.add_argument("--sample", action="store_true",
+                    help="Score frames in stratified random order and stop once the mean is tight enough")
+    ap.add_argument("--tol", type=float, default=0.01, help="CI half-width on mean P(real) for --sample")
+    ap.add_argument("--max-frames", type=int, default=None, help="Frame budget per video for --sample")
+    ap.add_argument("--min-frames", type=int, default=32, help="Minimum frames per video for --sample")
+    ap.add_argument("--seed", type=int, default=0, help="Sampling seed for --sample")
+    ap.add_argument("--shards", type=int, default=1,
+                    help="Worker processes splitting the frame list (0 = derive from core count)")
+    ap.add_argument("--threads-per-shard", type=int, default=0,
+                    help="torch/OpenMP threads per worker (0 = cores / shards)")
+    ap.add_argument("--quantize", action="store_true",
+                    help="int8 CPU inference (dynamic for ViT linears, calibrated static for Xception convs)")
+    ap.add_argument("--calib-frames", type=int, default=64, help="Calibration frames for --quantize")
+    ap.add_argument("--calib", default=None,
+                    help="Glob for the fixed static-int8 calibration set (default: the --real frames; "
+                         "gen frames are never used so the int8 model does not change per candidate)")
     args = ap.parse_args()
-
-    detectors = load_detectors(args.detectors)
+    if args.quantize and args.backend != "eager":
+        ap.error("--quantize only supports the eager backend")
+    if args.sample and args.shards != 1:
+        ap.error("--sample cannot be combined with --shards")
 
     real_paths = list_frames(args.real)
     gen_paths  = list_frames(args.gen)
@@ -82,8 +410,51 @@ def main():
         print("[Error] No frames found for both real and gen. Check paths.")
         return
 
-    p_real_real = infer_prob_real(detectors, real_paths) if len(real_paths) else np.array([])
-    p_real_gen  = infer_prob_real(detectors, gen_paths)  if len(gen_paths)  else np.array([])
+    cfg = vars(args)
+    if args.fast:
+        cfg["detectors"] = args.fast_detectors
+        print(f"[D-Score] Fast mode: distilled student {args.fast_detectors}")
+    # 較正セットは候補（gen）によらず固定する
+    calib_paths = list_frames(args.calib) if args.calib else real_paths
+    if args.quantize and not calib_paths:
+        ap.error("--quantize needs calibration frames: pass --calib or --real frames")
+
+    if args.shards != 1:
+        # ワーカーの初期化で失敗すると全シャードで同じエラーになるので、親で先に確かめる
+        if not os.path.exists(cfg["detectors"]):
+            ap.error(f"Detector registry not found: {cfg['detectors']}")
+        cores = available_cores()
+        shards, threads = default_shard_split(cores)
+        if args.shards > 1:
+            shards = args.shards
+            threads = max(1, cores // shards)
+        if args.threads_per_shard > 0:
+            threads = args.threads_per_shard
+        probs = infer_prob_real_sharded(cfg, {"real": real_paths, "gen": gen_paths}, shards, threads, calib_paths)
+        p_real_real, p_real_gen = probs["real"], probs["gen"]
+    else:
+        detectors, cache = setup_scoring(cfg, calib_paths)
+
+        if args.sample:
+            probs, stats = infer_prob_real_sequential(
+                detectors, {"real": real_paths, "gen": gen_paths}, args.batch_size,
+                args.tol, args.max_frames, args.min_frames, seed=args.seed, cache=cache,
+                workers=args.decode_workers, prefetch=args.prefetch)
+            p_real_real = probs.get("real", np.array([]))
+            p_real_gen  = probs.get("gen",  np.array([]))
+            print(f"[Sample] Scored real {len(p_real_real)}/{len(real_paths)}  "
+                  f"gen {len(p_real_gen)}/{len(gen_paths)} frames")
+            if "real" in stats and "gen" in stats:
+                d, se = cohens_d_stats(stats["real"], stats["gen"])
+                print(f"[Sample] Cohen's d = {d:.3f} ± {1.96*se:.3f} (95% CI)")
+        else:
+            loader_opts = dict(cache=cache, workers=args.decode_workers, prefetch=args.prefetch)
+            p_real_real = infer_prob_real(detectors, real_paths, args.batch_size, name="real", **loader_opts) if len(real_paths) else np.array([])
+            p_real_gen  = infer_prob_real(detectors, gen_paths,  args.batch_size, name="gen",  **loader_opts) if len(gen_paths)  else np.array([])
+
+        if cache is not None:
+            print(f"[Cache] {cache.hits} hits / {cache.misses} misses ({args.score_cache})")
+            cache.close()
 
     s_real = summarize("REAL  (P(real))", p_real_real) if len(p_real_real) else None
     s_gen  = summarize("GEN   (P(real))", p_real_gen)  if len(p_real_gen)  else None
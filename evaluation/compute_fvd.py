@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 # compute_fvd.py
 
+import argparse
+import csv
 import glob
+import hashlib
+import itertools
+import os
+import time
+from collections import deque
+import cv2
 import numpy as np
 import scipy.linalg as la
 import torch
-import torch.nn.functional as F
-from pytorchvideo.models.hub import i3d_r50
+from i3d_extractor import load_i3d, PRECISIONS, CACHE_ENV as I3D_CACHE_ENV, SHA256_ENV as I3D_SHA256_ENV
 
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-def frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
+def frechet_distance_sqrtm(mu1, sigma1, mu2, sigma2, eps=1e-6):
     """
     Fréchet 距離を安定的に計算（共分散に eps·I を足してから sqrtm）
+    ※ 参照実装。通常は frechet_distance（固有値分解版）を使う
     """
     diff = mu1 - mu2
     # eps·I を足して数値安定化
@@ -23,79 +31,683 @@ def frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     covmean = np.real_if_close(covmean, tol=1e-5)
     return diff.dot(diff) + np.trace(sigma1 + sigma2 - 2 * covmean)
 
-def extract_feats(clip_path, model, device):
+def trace_sqrt_product(sigma1, sigma2, rank=None):
     """
-    ・リサイズ／センタークロップ／正規化を追加
-    ・分類ヘッドを除いたブロックで特徴抽出
+    tr(sqrtm(Σ1·Σ2)) を対称行列の固有値から計算する。
+    Σ1 = V·diag(w)·Vᵀ, A = V·sqrt(w) とすると sqrt(Σ1)·Σ2·sqrt(Σ1) と Aᵀ·Σ2·A は
+    同じ非零固有値を持つので、tr = Σ sqrt(eig(Aᵀ·Σ2·A))。
+    rank を指定すると Σ1 の上位 rank 個の固有対だけを使う（クリップ数 N が特徴次元より
+    十分小さいとき、共分散の階数は N-1 以下なので rank=N-1 なら近似誤差はない）。
     """
-    data = np.load(clip_path)['frames']  # (T, H, W, C)
-    x = torch.from_numpy(data).permute(3,0,1,2).unsqueeze(0).float()  # (1, C, T, H, W)
+    dim = sigma1.shape[0]
+    if rank is None or rank >= dim:
+        w, v = np.linalg.eigh(sigma1)
+    else:
+        w, v = la.eigh(sigma1, subset_by_index=[dim - rank, dim - 1])
+    a = v * np.sqrt(np.clip(w, 0.0, None))
+    m = a.T @ sigma2 @ a
+    ev = np.linalg.eigvalsh((m + m.T) * 0.5)
+    return float(np.sqrt(np.clip(ev, 0.0, None)).sum())
+
+def frechet_distance(mu1, sigma1, mu2, sigma2, rank=None):
+    """
+    Fréchet 距離 ||μ1-μ2||² + tr(Σ1) + tr(Σ2) - 2·tr(sqrtm(Σ1·Σ2))。
+    固有値分解で計算するので eps·I による補正や複素数の後処理は不要。float64 で計算する。
+    """
+    mu1, mu2 = np.asarray(mu1, np.float64), np.asarray(mu2, np.float64)
+    sigma1, sigma2 = np.asarray(sigma1, np.float64), np.asarray(sigma2, np.float64)
+    diff = mu1 - mu2
+    return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2)
+                 - 2.0 * trace_sqrt_product(sigma1, sigma2, rank))
+
+def frechet_distance_features(feats1, feats2):
+    """
+    特徴行列から直接 Fréchet 距離を計算する（クリップ数 N が特徴次元 d より小さいときの低ランク経路）。
+    中心化した特徴を A = X1ᵀ/sqrt(N1-1), B = X2ᵀ/sqrt(N2-1) とすると Σ1 = AAᵀ, Σ2 = BBᵀ で、
+    tr(sqrtm(Σ1·Σ2)) は N1×N2 行列 AᵀB の特異値の和に等しい。d×d 行列を作らないので近似なしで高速。
+    """
+    x1 = np.asarray(feats1, np.float64)
+    x2 = np.asarray(feats2, np.float64)
+    mu1, mu2 = x1.mean(axis=0), x2.mean(axis=0)
+    a = (x1 - mu1) / np.sqrt(max(len(x1) - 1, 1))
+    b = (x2 - mu2) / np.sqrt(max(len(x2) - 1, 1))
+    diff = mu1 - mu2
+    tr_sqrt = np.linalg.svd(a @ b.T, compute_uv=False).sum()
+    return float(diff.dot(diff) + np.sum(a * a) + np.sum(b * b) - 2.0 * tr_sqrt)
 
-    # --- 前処理 (PyTorchVideo デフォルト) ---
-    # 短辺を256にスケール → 224×224でセンタークロップ
-    _, C, T, H, W = x.shape
+def _kernel_sum(x, y, block, exclude_diag=False):
+    """
+    多項式カーネル k(a, b) = (aᵀb/d + 1)³ の全要素和を行ブロックごとに計算する。
+    N×N のカーネル行列は作らず、block 行ずつの (block, N) だけを持つ。
+    exclude_diag=True（x と y が同じ集合）のときは対角成分を除く。
+    """
+    d = x.shape[1]
+    total = 0.0
+    for start in range(0, len(x), block):
+        k = (x[start:start+block] @ y.T / d + 1.0) ** 3
+        total += k.sum()
+        if exclude_diag:
+            total -= np.trace(k[:, start:start+block])
+    return total
+
+def kernel_mmd(x, y, block=1024):
+    """ 多項式カーネルによる MMD² の不偏推定量 """
+    m, n = len(x), len(y)
+    kxx = _kernel_sum(x, x, block, exclude_diag=True) / (m * (m - 1))
+    kyy = _kernel_sum(y, y, block, exclude_diag=True) / (n * (n - 1))
+    kxy = _kernel_sum(x, y, block) / (m * n)
+    return float(kxx + kyy - 2.0 * kxy)
+
+def kernel_video_distance(feats1, feats2, subsets=0, subset_size=1000, block=1024, seed=0):
+    """
+    KVD（I3D 特徴上の多項式カーネル MMD²、不偏）。FVD と違い共分散を推定しないので、
+    数百クリップ程度の短い動画でもバイアスが小さい。
+    subsets > 0 のときは各側から subset_size 本を非復元抽出した MMD² を subsets 回平均する。
+    return: (KVD, subsets > 0 のときは標準偏差、それ以外は None)
+    """
+    x = np.asarray(feats1, np.float64)
+    y = np.asarray(feats2, np.float64)
+    if subsets <= 0:
+        return kernel_mmd(x, y, block), None
+    rng = np.random.default_rng(seed)
+    size = min(subset_size, len(x), len(y))
+    vals = [kernel_mmd(x[rng.choice(len(x), size, replace=False)],
+                       y[rng.choice(len(y), size, replace=False)], block)
+            for _ in range(subsets)]
+    return float(np.mean(vals)), float(np.std(vals))
+
+# PyTorchVideo デフォルトの前処理パラメータ
+SHORT_SIDE = 256
+CROP_SIZE  = 224
+VIDEO_MEAN = 0.45
+VIDEO_STD  = 0.225
+# 前処理を変えたら上げる（--frame-cache のキーに含まれる）
+FRAME_CACHE_VERSION = 1
+
+def resize_crop_frame(frame):
+    """
+    uint8 のまま 短辺を256にスケール（cv2 bilinear）→ 224×224 センタークロップ。
+    時間方向のサイズは変えないので、従来の trilinear 補間はフレームごとの bilinear と同じ。
+    """
+    H, W = frame.shape[:2]
     if H < W:
-        new_h, new_w = 256, int(W * 256 / H)
+        new_h, new_w = SHORT_SIDE, int(W * SHORT_SIDE / H)
     else:
-        new_h, new_w = int(H * 256 / W), 256
-    x = F.interpolate(x, size=(T, new_h, new_w), mode='trilinear', align_corners=False)
+        new_h, new_w = int(H * SHORT_SIDE / W), SHORT_SIDE
+    if (new_h, new_w) != (H, W):
+        frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    h_off = (new_h - CROP_SIZE) // 2
+    w_off = (new_w - CROP_SIZE) // 2
+    return frame[h_off:h_off+CROP_SIZE, w_off:w_off+CROP_SIZE]
 
-    h_off = (new_h - 224) // 2
-    w_off = (new_w - 224) // 2
-    x = x[:,:,:, h_off:h_off+224, w_off:w_off+224]
-
-    # チャンネル正規化：video_mean=(0.45,0.45,0.45), video_std=(0.225,0.225,0.225) :contentReference[oaicite:0]{index=0}
-    mean = torch.tensor([0.45, 0.45, 0.45]).view(1,3,1,1,1)
-    std  = torch.tensor([0.225,0.225,0.225]).view(1,3,1,1,1)
-    x = (x / 255.0 - mean) / std
+def normalize_into(frames, out):
+    """
+    uint8 (..., H, W, C) を (x/255 - mean)/std して out (C, ..., H, W) に書き込む。
+    スケールとシフトを1回の乗算＋減算にまとめ、中間配列を作らない。
+    """
+    src = np.moveaxis(frames, -1, 0)
+    np.multiply(src, np.float32(1.0 / (255.0 * VIDEO_STD)), out=out)
+    out -= np.float32(VIDEO_MEAN / VIDEO_STD)
+    return out
 
-    x = x.to(device)
+def load_clip(clip_path):
+    """ クリップを読み込み、フレームごとにリサイズ・クロップした uint8 (T, 224, 224, C) を返す """
+    data = np.load(clip_path)['frames']  # (T, H, W, C)
+    return np.stack([resize_crop_frame(f) for f in data])
 
-    # --- 分類ヘッド直前のプーリング特徴を抽出（blocks[:-1]） :contentReference[oaicite:1]{index=1} ---
+def forward_features(model, x):
+    """ headless I3D（i3d_extractor.load_i3d）でプーリング特徴 (B, 2048) を抽出 """
     with torch.no_grad():
-        f = x
-        for blk in model.blocks[:-1]:
-            f = blk(f)
-        # 時間＋空間 次元で平均プール → (1, 2048)
-        f = f.mean(dim=[2,3,4])
+        f = model(x)
+    return f.float().cpu().numpy()
 
-    return f.cpu().numpy().reshape(-1)
+def valid_rows(feats):
+    """ 読めないフレームをまたぐクリップの行（NaN、iter_feats_frames 参照）を除く """
+    return feats[~np.isnan(feats[:, 0])]
 
-def main():
-    print("[FVD] Loading I3D model...")
-    model = i3d_r50(pretrained=True).eval().to(DEVICE)
-
-    # 実動画・生成動画クリップのパス収集
-    real_paths = sorted(glob.glob("clips/real/*.npz"))
-    gen_paths  = sorted(glob.glob("clips/gen/*.npz"))
-
-    # 特徴抽出
-    print(f"[FVD] Extracting features: real={len(real_paths)}, gen={len(gen_paths)}")
-    # real clips
-    r_feats = []
-    for idx, p in enumerate(real_paths, start=1):
-        print(f"[FVD] Real clip {idx}/{len(real_paths)}", end='\r', flush=True)
-        r_feats.append(extract_feats(p, model, DEVICE))
+class FeatureStats:
+    """
+    I3D 特徴の平均・共分散を逐次計算するアキュムレータ。
+    特徴の和と外積の和を float64 で保持するだけなので、動画の長さによらずメモリは O(d²) で一定。
+    シャードごとに計算したものを merge / .npz の save・load で合算できる。
+    """
+    def __init__(self, dim=None):
+        self.n = 0
+        self.sum = None    # (d,)   特徴の和
+        self.outer = None  # (d, d) 外積の和
+        if dim is not None:
+            self._alloc(dim)
+
+    def _alloc(self, dim):
+        self.sum = np.zeros(dim, dtype=np.float64)
+        self.outer = np.zeros((dim, dim), dtype=np.float64)
+
+    def update(self, feats):
+        """ feats: (B, d) の特徴バッチを加算（次元は最初のバッチで決まる。NaN の行は飛ばす） """
+        f = valid_rows(np.asarray(feats, dtype=np.float64))
+        if self.sum is None:
+            self._alloc(f.shape[1])
+        self.n += len(f)
+        self.sum += f.sum(axis=0)
+        self.outer += f.T @ f
+        return self
+
+    def merge(self, other):
+        if other.sum is None:
+            return self
+        if self.sum is None:
+            self._alloc(len(other.sum))
+        self.n += other.n
+        self.sum += other.sum
+        self.outer += other.outer
+        return self
+
+    def remove(self, other):
+        """ merge の逆（スライディングウィンドウから古いブロックを外す） """
+        self.n -= other.n
+        self.sum -= other.sum
+        self.outer -= other.outer
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / max(self.n, 1)
+
+    def cov(self):
+        """ np.cov(feats, rowvar=False) と同じ不偏共分散 """
+        mu = self.mean
+        return (self.outer - self.n * np.outer(mu, mu)) / max(self.n - 1, 1)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, n=self.n, sum=self.sum, outer=self.outer)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls(len(data['sum']))
+        stats.n = int(data['n'])
+        stats.sum[:] = data['sum']
+        stats.outer[:] = data['outer']
+        return stats
+
+def iter_feats_clips(clip_paths, model, device, batch_size=8, desc="clip", load=load_clip):
+    """
+    クリップを batch_size 本ずつまとめて I3D に通し、(B, 2048) の特徴バッチを順に yield する。
+    前処理は uint8 のままリサイズし、正規化は事前確保したバッファに直接書き込む。
+    load: clip_paths の要素 → uint8 (T, 224, 224, C)（読み込み済みのクリップなら恒等関数を渡す）
+    """
+    buf = None
+    total = len(clip_paths)
+    for start in range(0, total, batch_size):
+        clips = [load(p) for p in clip_paths[start:start+batch_size]]
+        B = len(clips)
+        T = clips[0].shape[0]
+        if buf is None or buf.shape[0] < B:
+            buf = torch.empty((B, 3, T, CROP_SIZE, CROP_SIZE), dtype=torch.float32)
+        x = buf[:B]
+        x_np = x.numpy()
+        for i, clip in enumerate(clips):
+            normalize_into(clip, x_np[i])
+        yield forward_features(model, x.to(device))
+        print(f"[FVD] {desc} {start+B}/{total}", end='\r', flush=True)
     print()  # 改行
-    # gen clips
-    g_feats = []
-    for idx, p in enumerate(gen_paths, start=1):
-        print(f"[FVD] Gen clip  {idx}/{len(gen_paths)}", end='\r', flush=True)
-        g_feats.append(extract_feats(p, model, DEVICE))
+
+def extract_feats(clip_paths, model, device, batch_size=8, desc="clip", load=load_clip):
+    """ クリップの I3D 特徴 (N, 2048) をまとめて返す """
+    feats = list(iter_feats_clips(clip_paths, model, device, batch_size, desc, load))
+    return np.concatenate(feats) if feats else np.zeros((0, 2048), dtype=np.float32)
+
+def list_frame_files(frame_dir):
+    return sorted(f for f in os.listdir(frame_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+
+def iter_preprocessed_frames(frame_dir):
+    """
+    アライン済みフレームを順に1回だけ前処理し、(3, 224, 224) の float32 を yield する（保持しない）。
+    読めないフレームは詰めずに None（欠落の印）を yield し、フレーム番号をずらさない。
+    """
+    for fn in list_frame_files(frame_dir):
+        img = cv2.imread(os.path.join(frame_dir, fn))
+        if img is None:
+            print(f"Warning: Could not read image {os.path.join(frame_dir, fn)}")
+            yield None
+            continue
+        yield normalize_into(resize_crop_frame(img), np.empty((3, CROP_SIZE, CROP_SIZE), dtype=np.float32))
+
+def frames_fingerprint(frame_dir, files):
+    """ ファイル名・サイズ・更新時刻と前処理の設定からフレームキャッシュのキーを作る（内容は読まない） """
+    h = hashlib.sha256(f"v{FRAME_CACHE_VERSION}|{SHORT_SIDE}|{CROP_SIZE}|{VIDEO_MEAN}|{VIDEO_STD}".encode())
+    for fn in files:
+        st = os.stat(os.path.join(frame_dir, fn))
+        h.update(f"{os.path.abspath(os.path.join(frame_dir, fn))}|{st.st_size}|{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()[:16]
+
+def preprocess_frames(frame_dir, cache_dir=None):
+    """
+    アライン済みフレームを1枚ずつ1回だけ前処理し、(N, 3, 224, 224) の float32 配列にまとめる。
+    cache_dir を指定すると <cache_dir>/<fingerprint>.npy のメモリマップに書き出し（長い動画でもメモリを
+    圧迫しない）、フレームが変わっていなければ次回からはそれを読むだけにする。
+    読めないフレームは先頭要素を NaN にして残す（iter_feats_frames が欠落として扱う）。
+    """
+    files = list_frame_files(frame_dir)
+    shape = (len(files), 3, CROP_SIZE, CROP_SIZE)
+    if not cache_dir:
+        out = np.empty(shape, dtype=np.float32)
+        _fill_frames(frame_dir, out)
+        return out
+    path = os.path.join(cache_dir, frames_fingerprint(frame_dir, files) + ".npy")
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+    os.makedirs(cache_dir, exist_ok=True)
+    # 一時ファイルに書いてから rename（中断しても壊れたキャッシュを残さない）
+    tmp = f"{path}.{os.getpid()}.tmp.npy"
+    try:
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=shape)
+        _fill_frames(frame_dir, out)
+        out.flush()
+        del out
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return np.load(path, mmap_mode='r')
+
+def _fill_frames(frame_dir, out):
+    for n, frame in enumerate(iter_preprocessed_frames(frame_dir)):
+        if frame is None:
+            out[n, 0, 0, 0] = np.nan
+        else:
+            out[n] = frame
+
+def iter_feats_frames(frames, model, device, batch_size=8, clip_len=16, desc="clip"):
+    """
+    前処理済みフレーム (3, 224, 224) の列から stride 1 の clip_len フレームのクリップを作り、
+    I3D 特徴バッチ (B, 2048) を順に yield する。clips/ の npz（clip_split.py）と同じクリップ列になる。
+    保持するのは batch_size+clip_len-1 フレームのリングバッファだけなので、フレーム数によらずメモリは一定。
+
+    読めないフレーム（None または先頭要素が NaN）をまたぐクリップは clip_split.py と同じく捨てるが、
+    クリップ i がフレーム i から始まる対応を保つため、その位置には NaN の行を出す
+    （FeatureStats などは NaN の行を飛ばす。タイムラインの時刻はずれない）。
+    """
+    span = batch_size + clip_len - 1
+    ring = np.empty((span, 3, CROP_SIZE, CROP_SIZE), dtype=np.float32)
+    buf = torch.empty((batch_size, 3, clip_len, CROP_SIZE, CROP_SIZE), dtype=torch.float32)
+    n = 0        # リングバッファ内のフレーム数
+    done = 0     # 出力済みクリップ数（NaN の行を含む）
+    total = 0    # 読んだフレーム数（欠落を含む）
+    skipped = 0  # まだ出していない、欠落をまたぐクリップの数
+    dim = 2048
+
+    def run(m):
+        """ リング先頭 m フレームの全クリップの特徴（未出力の欠落分の NaN 行を前に付ける） """
+        nonlocal done, skipped, dim
+        # (B, 3, 224, 224, T) のビュー → (B, 3, T, 224, 224)
+        windows = np.moveaxis(np.lib.stride_tricks.sliding_window_view(ring[:m], clip_len, axis=0), -1, 2)
+        x = buf[:len(windows)]
+        np.copyto(x.numpy(), windows)
+        f = forward_features(model, x.to(device))
+        dim = f.shape[1]
+        if skipped:
+            f = np.concatenate([np.full((skipped, dim), np.nan, dtype=f.dtype), f])
+            skipped = 0
+        done += len(f)
+        print(f"[FVD] {desc} {done}", end='\r', flush=True)
+        return f
+
+    for frame in frames:
+        total += 1
+        if frame is None or np.isnan(frame[0, 0, 0]):
+            # 欠落の手前で完成しているクリップを出し、欠落を含むクリップの数を数えてリングを空にする
+            if n >= clip_len:
+                yield run(n)
+            skipped += min(n, clip_len - 1) + 1
+            n = 0
+            continue
+        ring[n] = frame
+        n += 1
+        if n == span:
+            yield run(n)
+            # 次のバッチの先頭クリップに必要な末尾 clip_len-1 フレームを先頭へ移す
+            ring[:clip_len-1] = ring[n-clip_len+1:n]
+            n = clip_len - 1
+    if n >= clip_len:
+        yield run(n)
+    # 末尾の欠落: クリップ数が total-clip_len+1 になるまで NaN の行で埋める
+    tail = max(0, total - clip_len + 1) - done
+    if tail > 0:
+        yield np.full((tail, dim), np.nan, dtype=np.float32)
     print()  # 改行
 
-    # 統計量計算
-    r_feats = np.stack(r_feats)
-    g_feats = np.stack(g_feats)
-    mu_r = r_feats.mean(axis=0)
-    mu_g = g_feats.mean(axis=0)
-    sigma_r = np.cov(r_feats, rowvar=False)
-    sigma_g = np.cov(g_feats, rowvar=False)
+def extract_feats_frames(frames, model, device, batch_size=8, clip_len=16, desc="clip"):
+    """ 前処理済みフレーム (N, 3, 224, 224) から I3D 特徴 (N-clip_len+1, 2048) をまとめて返す（欠落をまたぐ行は NaN） """
+    feats = list(iter_feats_frames(frames, model, device, batch_size, clip_len, desc))
+    return np.concatenate(feats) if feats else np.zeros((0, 2048), dtype=np.float32)
+
+def video_features(src, model, device, batch_size, desc, frame_cache=None):
+    """
+    src がディレクトリならフレームモード、それ以外はクリップ npz の glob として
+    特徴バッチ (B, 2048) を順に yield する。
+    """
+    if os.path.isdir(src):
+        if frame_cache:
+            t0 = time.perf_counter()
+            frames = preprocess_frames(src, frame_cache)
+            print(f"[FVD] {desc}: {len(frames)} preprocessed frames ready in {time.perf_counter()-t0:.1f}s "
+                  f"({frame_cache})")
+        else:
+            frames = iter_preprocessed_frames(src)
+        yield from iter_feats_frames(frames, model, device, batch_size, desc=f"{desc} clip")
+        return
+    paths = sorted(glob.glob(src))
+    print(f"[FVD] {desc}: {len(paths)} clips")
+    yield from iter_feats_clips(paths, model, device, batch_size, desc=f"{desc} clip")
+
+def collect_stats(src, stats_paths, model, device, batch_size, desc, frame_cache=None, keep_feats=False):
+    """
+    stats_paths の .npz を読み込んで合算し、src があればその特徴も逐次加算する。
+    return: (FeatureStats, 特徴 (N, 2048) または None)。特徴は keep_feats のときだけ保持する。
+    """
+    stats = FeatureStats()
+    for path in stats_paths:
+        stats.merge(FeatureStats.load(path))
+        print(f"[FVD] {desc}: merged statistics from {path}")
+    feats = [] if keep_feats and not stats_paths else None
+    if src:
+        for f in video_features(src, model, device, batch_size, desc, frame_cache):
+            stats.update(f)
+            if feats is not None:
+                feats.append(valid_rows(f))
+    print(f"[FVD] {desc}: {stats.n} clips in statistics")
+    if feats is not None:
+        feats = np.concatenate(feats) if feats else np.zeros((0, 2048), dtype=np.float32)
+    return stats, feats
+
+def iter_blocks(batches, block_size):
+    """ 特徴バッチの列を block_size クリップずつの塊に詰め直す（最後は端数のまま） """
+    pending, n = [], 0
+    for f in batches:
+        while len(f):
+            take = min(block_size - n, len(f))
+            pending.append(f[:take])
+            n += take
+            f = f[take:]
+            if n == block_size:
+                yield np.concatenate(pending)
+                pending, n = [], 0
+    if n:
+        yield np.concatenate(pending)
+
+def fvd_timeline(real_batches, gen_batches, block_size, blocks_per_window, fps, clip_len=16, keep_feats=False):
+    """
+    時間方向のスライディングウィンドウごとの FVD を計算する。
+    クリップ i は両側ともフレーム i から始まる（stride 1）ので、同じ時刻のブロック同士を比べる。
+    ウィンドウ統計はブロック統計の累積和の差（新しいブロックを足し、外れたブロックを引く）で
+    O(d²) で更新し、特徴の再抽出はしない。keep_feats のときはウィンドウ内の特徴から距離を計算する。
+    長さが違う場合、タイムラインは短い方の長さまでだが、全体の統計には長い方の残りも含める
+    （タイムラインなしの実行と同じ全体 FVD になる）。
+    return: (行の list, 全体の real 統計, 全体の gen 統計)
+    """
+    real_total, gen_total = FeatureStats(), FeatureStats()
+    real_win, gen_win = FeatureStats(), FeatureStats()
+    blocks = deque()
+    rows = []
+    start = 0   # ウィンドウ先頭クリップの番号
+    length = 0  # ウィンドウ内のクリップ位置の数（欠落をまたぐ NaN の行も数える）
+    real_len = gen_len = 0
+
+    def emit():
+        n = min(real_win.n, gen_win.n)
+        if n < 2:
+            return
+        if keep_feats and n < len(real_win.sum):
+            fvd = frechet_distance_features(valid_rows(np.concatenate([b[2] for b in blocks])),
+                                            valid_rows(np.concatenate([b[3] for b in blocks])))
+        else:
+            rank = real_win.n - 1 if real_win.n - 1 < len(real_win.sum) else None
+            fvd = frechet_distance(real_win.mean, real_win.cov(), gen_win.mean, gen_win.cov(), rank)
+        end = start + length - 1 + clip_len
+        rows.append({"window": len(rows), "start_sec": start / fps, "end_sec": end / fps,
+                     "clips": real_win.n, "fvd": fvd})
+        print(f"[FVD] window {len(rows)-1}: {start/fps:7.1f}s - {end/fps:7.1f}s  FVD={fvd:.2f}")
+
+    for r, g in itertools.zip_longest(iter_blocks(real_batches, block_size), iter_blocks(gen_batches, block_size)):
+        real_len += 0 if r is None else len(r)
+        gen_len += 0 if g is None else len(g)
+        if r is None or g is None:
+            # 長い方の残りは全体の統計にだけ加える
+            (gen_total if r is None else real_total).update(g if r is None else r)
+            continue
+        m = min(len(r), len(g))
+        real_total.update(r[m:])
+        gen_total.update(g[m:])
+        r, g = r[:m], g[:m]
+        r_stats, g_stats = FeatureStats().update(r), FeatureStats().update(g)
+        real_total.merge(r_stats)
+        gen_total.merge(g_stats)
+        blocks.append((r_stats, g_stats, r if keep_feats else None, g if keep_feats else None, m))
+        real_win.merge(r_stats)
+        gen_win.merge(g_stats)
+        length += m
+        if len(blocks) > blocks_per_window:
+            old_r, old_g, _, _, old_m = blocks.popleft()
+            real_win.remove(old_r)
+            gen_win.remove(old_g)
+            start += old_m
+            length -= old_m
+        if len(blocks) == blocks_per_window:
+            emit()
+    if len(blocks) < blocks_per_window:
+        # ウィンドウ1つ分に満たない短い動画は全体を1ウィンドウとする
+        emit()
+    if real_len != gen_len:
+        print(f"[FVD] WARNING: real has {real_len} clips but gen has {gen_len}; the timeline covers the first "
+              f"{min(real_len, gen_len)} clips, the overall FVD uses all clips of both")
+    return rows, real_total, gen_total
+
+def write_timeline(rows, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["window", "start_sec", "end_sec", "clips", "fvd"])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({**row, "start_sec": f"{row['start_sec']:.3f}",
+                             "end_sec": f"{row['end_sec']:.3f}", "fvd": f"{row['fvd']:.4f}"})
+
+def parity_inputs(src, n_clips, clip_len=16):
+    """ 基準ペア用に先頭 n_clips クリップ分の入力を一度だけ前処理して返す（全精度で使い回す） """
+    if os.path.isdir(src):
+        return "frames", list(itertools.islice(iter_preprocessed_frames(src), n_clips + clip_len - 1))
+    return "clips", [load_clip(p) for p in sorted(glob.glob(src))[:n_clips]]
+
+def parity_ok(value, ref, rel_tol, scale=1.0):
+    """
+    |value - ref| が max(|ref|, scale) の rel_tol 倍以内か。
+    FVD は大きな項の差なので、--parity では scale に tr Σ_real + tr Σ_gen（桁落ちの大きさ）を渡す
+    """
+    return abs(value - ref) <= rel_tol * max(abs(ref), scale)
+
+def precision_parity(real_src, gen_src, ref_model, model, device, batch_size, n_clips, precision="bf16",
+                     tol=0.02):
+    """
+    基準ペア（real/gen の先頭 n_clips クリップ）で fp32 と低精度の特徴・FVD・スループットを比較する。
+    入力の前処理は real/gen それぞれ1回だけで、計測するのは I3D の特徴抽出のみ。
+    return: 低精度の FVD が fp32 の相対誤差 tol 以内なら True
+    """
+    inputs = [(side,) + parity_inputs(src, n_clips) for side, src in (("Real", real_src), ("Gen", gen_src))]
+    results = {}
+    for name, m in (("fp32", ref_model), (precision, model)):
+        t0 = time.perf_counter()
+        feats = []
+        for side, kind, data in inputs:
+            desc = f"Parity {name} {side} clip"
+            if kind == "frames":
+                f = extract_feats_frames(data, m, device, batch_size, desc=desc)
+            else:
+                f = extract_feats(data, m, device, batch_size, desc, load=lambda clip: clip)
+            feats.append(valid_rows(f))
+        elapsed = time.perf_counter() - t0
+        results[name] = (feats, frechet_distance_features(*feats), sum(len(f) for f in feats) / elapsed)
+    (ref_feats, ref_fvd, ref_cps), (feats, fvd, cps) = results["fp32"], results[precision]
+    feat_err = max(float(np.abs(a - b).max()) for a, b in zip(feats, ref_feats))
+    print(f"[FVD] Precision parity on {len(ref_feats[0])}/{len(ref_feats[1])} reference clips")
+    print(f"[FVD]   FVD fp32={ref_fvd:.4f}  {precision}={fvd:.4f}  |Δ|={abs(fvd-ref_fvd):.4g} "
+          f"({abs(fvd-ref_fvd)/max(abs(ref_fvd), 1e-12)*100:.3f}%)  max|Δfeat|={feat_err:.3g}")
+    print(f"[FVD]   throughput fp32={ref_cps:.2f}  {precision}={cps:.2f} clips/s ({cps/ref_cps:.2f}x)")
+    ok = parity_ok(fvd, ref_fvd, tol)
+    print(f"[FVD]   precision parity {'OK' if ok else 'FAILED'} (tolerance {tol*100:g}% of the fp32 FVD)")
+    return ok
+
+def main():
+    ap = argparse.ArgumentParser(description="Compute Fréchet Video Distance between real and gen clips")
+    ap.add_argument("--real", default=None,
+                    help="Glob for real clips, or a directory of aligned frames (default: clips/real/*.npz "
+                         "unless --real-stats is given)")
+    ap.add_argument("--gen",  default=None,
+                    help="Glob for gen clips, or a directory of aligned frames (default: clips/gen/*.npz "
+                         "unless --gen-stats is given)")
+    ap.add_argument("--real-stats", nargs="+", default=[],
+                    help="Saved feature statistics (.npz) merged into the real side")
+    ap.add_argument("--gen-stats", nargs="+", default=[],
+                    help="Saved feature statistics (.npz) merged into the gen side")
+    ap.add_argument("--save-real-stats", default=None, help="Write the merged real statistics to this .npz")
+    ap.add_argument("--save-gen-stats", default=None, help="Write the merged gen statistics to this .npz")
+    ap.add_argument("--batch-size", type=int, default=8, help="Clips per I3D forward pass")
+    ap.add_argument("--low-rank", action="store_true",
+                    help="Compute the distance from the clip features when clips < 2048 (exact, avoids d×d eigendecompositions)")
+    ap.add_argument("--parity", action="store_true",
+                    help="Also compute the distance with the sqrtm reference; exit 1 if it differs by more "
+                         "than --parity-tol")
+    ap.add_argument("--parity-tol", type=float, default=1e-6,
+                    help="Tolerance of --parity, relative to max(FVD, tr Σ_real + tr Σ_gen)")
+    ap.add_argument("--frame-cache", default=None,
+                    help="Directory for memory-mapped preprocessed frames (frame-directory mode); "
+                         "reused while the frame files (name/size/mtime) are unchanged")
+    ap.add_argument("--i3d-cache", default=None,
+                    help=f"Directory holding I3D_8x8_R50.pyth and the frozen extractor (default: ${I3D_CACHE_ENV} or ~/.cache)")
+    ap.add_argument("--allow-download", action="store_true",
+                    help="Download the I3D checkpoint if it is not in the cache")
+    ap.add_argument("--checkpoint-sha256", default=None,
+                    help=f"Expected sha256 of the I3D checkpoint (default: ${I3D_SHA256_ENV} or the pinned value)")
+    ap.add_argument("--trust-checkpoint", action="store_true",
+                    help="Use the I3D checkpoint even if no sha256 is pinned or it does not match")
+    ap.add_argument("--precision", choices=PRECISIONS, default="fp32",
+                    help="bf16: eager I3D with bfloat16 autocast and channels_last_3d (bf16-capable CPUs/GPUs)")
+    ap.add_argument("--precision-parity", type=int, default=0, metavar="N",
+                    help="With --precision bf16, first compare FVD and throughput against fp32 on the first N clips "
+                         "and exit 1 if the FVD differs by more than --precision-tol")
+    ap.add_argument("--precision-tol", type=float, default=0.02,
+                    help="Relative FVD tolerance of --precision-parity against fp32")
+    ap.add_argument("--kvd", action="store_true",
+                    help="Also report the unbiased polynomial-kernel KVD on the same features")
+    ap.add_argument("--kvd-subsets", type=int, default=0,
+                    help="Average KVD over this many random subsets (0 = use all clips once)")
+    ap.add_argument("--kvd-subset-size", type=int, default=1000, help="Clips per side in each KVD subset")
+    ap.add_argument("--timeline", default=None,
+                    help="Write per-window FVD over time to this CSV (--real/--gen must be frame directories)")
+    ap.add_argument("--window-sec", type=float, default=10.0, help="Timeline window length in seconds")
+    ap.add_argument("--step-sec", type=float, default=2.0, help="Timeline window step in seconds")
+    ap.add_argument("--fps", type=float, default=30.0, help="Frame rate of the aligned frames")
+    args = ap.parse_args()
+    if args.timeline and (args.real_stats or args.gen_stats):
+        ap.error("--timeline needs features extracted in this run; it cannot use --real-stats/--gen-stats")
+    if args.kvd and (args.timeline or args.real_stats or args.gen_stats):
+        ap.error("--kvd needs the clip features of this run; it cannot be combined with "
+                 "--timeline or --real-stats/--gen-stats")
+    if args.real is None and not args.real_stats:
+        args.real = "clips/real/*.npz"
+    if args.gen is None and not args.gen_stats:
+        args.gen = "clips/gen/*.npz"
+    if args.timeline and not (os.path.isdir(args.real) and os.path.isdir(args.gen)):
+        ap.error("--timeline needs frame directories for --real and --gen "
+                 "(clip globs are not frame-aligned; their clip indices skip missing clips)")
+
+    model = None
+    if args.real or args.gen:
+        print("[FVD] Loading I3D model...")
+        t0 = time.perf_counter()
+        pin = dict(sha256=args.checkpoint_sha256, trust=args.trust_checkpoint)
+        model = load_i3d(DEVICE, args.i3d_cache, args.allow_download, precision=args.precision, **pin)
+        print(f"[FVD] I3D ({args.precision}) ready in {time.perf_counter()-t0:.1f}s")
+        if args.precision != "fp32" and args.precision_parity > 0 and args.real and args.gen:
+            if not precision_parity(args.real, args.gen, load_i3d(DEVICE, args.i3d_cache, **pin), model, DEVICE,
+                                    args.batch_size, args.precision_parity, args.precision, args.precision_tol):
+                raise SystemExit(f"[FVD] {args.precision} FVD drifted more than {args.precision_tol*100:g}% "
+                                 "from fp32; use --precision fp32")
+
+    # 特徴抽出と統計量の逐次計算（特徴は --low-rank / --kvd のときだけ保持）
+    keep_feats = args.low_rank or args.kvd
+    print("[FVD] Extracting features")
+    if args.timeline:
+        step = max(1, round(args.step_sec * args.fps))
+        k = max(1, round(args.window_sec / args.step_sec))
+        print(f"[FVD] Timeline: window {k*step} clips, step {step} clips at {args.fps:g} fps")
+        rows, real, gen = fvd_timeline(
+            video_features(args.real, model, DEVICE, args.batch_size, "Real", args.frame_cache),
+            video_features(args.gen,  model, DEVICE, args.batch_size, "Gen",  args.frame_cache),
+            step, k, args.fps, keep_feats=args.low_rank)
+        write_timeline(rows, args.timeline)
+        if rows:
+            worst = max(rows, key=lambda row: row["fvd"])
+            print(f"[FVD] Timeline: {len(rows)} windows written to {args.timeline}  worst window "
+                  f"{worst['start_sec']:.1f}s - {worst['end_sec']:.1f}s  FVD={worst['fvd']:.2f}")
+        r_feats = g_feats = None
+    else:
+        real, r_feats = collect_stats(args.real, args.real_stats, model, DEVICE, args.batch_size, "Real",
+                                      args.frame_cache, keep_feats=keep_feats)
+        gen,  g_feats = collect_stats(args.gen,  args.gen_stats,  model, DEVICE, args.batch_size, "Gen",
+                                      args.frame_cache, keep_feats=keep_feats)
+    if real.n < 2 or gen.n < 2:
+        print(f"[FVD] Need at least 2 clips per side (real={real.n}, gen={gen.n})")
+        return
+    if args.save_real_stats:
+        real.save(args.save_real_stats)
+        print(f"[FVD] Real statistics saved to {args.save_real_stats}")
+    if args.save_gen_stats:
+        gen.save(args.save_gen_stats)
+        print(f"[FVD] Gen statistics saved to {args.save_gen_stats}")
+
+    mu_r, sigma_r = real.mean, real.cov()
+    mu_g, sigma_g = gen.mean, gen.cov()
 
     # FVD 計算
     print("[FVD] Computing Fréchet Video Distance...")
-    fvd_value = frechet_distance(mu_r, sigma_r, mu_g, sigma_g)
-    print(f"[FVD] FVD: {fvd_value:.2f}")
+    dim = len(mu_r)
+    t0 = time.perf_counter()
+    if args.low_rank and r_feats is not None and g_feats is not None and max(real.n, gen.n) < dim:
+        fvd_value = frechet_distance_features(r_feats, g_feats)
+    else:
+        # 保存済み統計量だけのときは Σ_real の階数 (N-1) までの固有対で足りる
+        rank = real.n - 1 if args.low_rank and real.n - 1 < dim else None
+        fvd_value = frechet_distance(mu_r, sigma_r, mu_g, sigma_g, rank)
+    print(f"[FVD] FVD: {fvd_value:.2f}  ({(time.perf_counter()-t0)*1e3:.0f} ms)")
+    if args.kvd:
+        t0 = time.perf_counter()
+        kvd_value, kvd_std = kernel_video_distance(r_feats, g_feats, args.kvd_subsets, args.kvd_subset_size)
+        spread = f" ± {kvd_std:.4g} ({args.kvd_subsets} subsets)" if kvd_std is not None else ""
+        print(f"[FVD] KVD: {kvd_value:.6g}{spread}  ({(time.perf_counter()-t0)*1e3:.0f} ms)")
+    if args.parity:
+        t0 = time.perf_counter()
+        eps = 1e-6
+        ref = frechet_distance_sqrtm(mu_r, sigma_r, mu_g, sigma_g, eps)
+        print(f"[FVD] sqrtm reference: {ref:.2f}  ({(time.perf_counter()-t0)*1e3:.0f} ms)  "
+              f"|Δ| = {abs(fvd_value - ref):.4g}")
+        # 参照は sqrtm の中だけ共分散に eps·I を足している（トレース項は足さない）ので、同じ eps を足した
+        # 固有値分解版から 2·d·eps を引いて比べる（eps による偏りを除く）。
+        # 低ランク近似で求めた値は、eps なしの全ランクの固有値分解版と比べる
+        offset = eps * np.eye(dim)
+        checks = [("eigendecomposition vs sqrtm (same eps)",
+                   frechet_distance(mu_r, sigma_r + offset, mu_g, sigma_g + offset) - 2 * dim * eps, ref)]
+        if args.low_rank:
+            checks.append(("low-rank vs full rank", fvd_value, frechet_distance(mu_r, sigma_r, mu_g, sigma_g)))
+        scale = float(np.trace(sigma_r) + np.trace(sigma_g))
+        failed = False
+        for name, value, expected in checks:
+            ok = parity_ok(value, expected, args.parity_tol, scale)
+            failed |= not ok
+            print(f"[FVD] Parity {name}: |Δ| = {abs(value - expected):.4g}  {'OK' if ok else 'FAILED'}")
+        if failed:
+            raise SystemExit(f"[FVD] Parity FAILED (tolerance {args.parity_tol:g} relative)")
 
 if __name__ == '__main__':
     main()
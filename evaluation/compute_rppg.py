@@ -2,89 +2,229 @@
 # compute_rppg.py
 
 import argparse
-import glob
-import pickle
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import cv2
-from scipy.signal import butter, filtfilt
+
+current_dir   = os.path.dirname(os.path.abspath(__file__))
+training_dir  = os.path.join(current_dir, '..', 'training')
+sys.path.insert(0, os.path.abspath(training_dir))
+
+from rppg_features import extract_features, open_source, iter_window_features, RoiSampler
+from rppg_model import load_model, MODEL_PATH
+from generate_rppg_features import list_samples, parse_landmarks
 
 """
 Compute rPPG Realness Score using a trained logistic regression model.
 Extracts patch-based green-channel signals from aligned frames,
 filters them, computes pairwise correlations, and predicts realness.
+The feature engine (training/rppg_features.py) is shared with training.
+With --window-sec, a causal band-pass and rolling correlations give one
+feature vector and P(real) per sliding window (constant memory).
+Several sources (frame directories, videos, .npy stores, or directories of
+videos) can be scored in one run: features are extracted in a process pool
+and all sources are scored with one predict_proba over the stacked matrix.
+The model is the pickle-free rppg_model.json (training/rppg_model.py); its
+recorded grid/patch/fps/ROI settings drive the feature extraction.
 Usage:
-    python compute_rppg.py --aligned_dir frames/aligned/gen --model rppg_model.pkl
+    python compute_rppg.py --aligned_dir frames/aligned/gen --model rppg_model.json
+    python compute_rppg.py --aligned_dir clips/gen/*/ --workers 8 --out rppg_scores.csv
+    python compute_rppg.py --aligned_dir frames/aligned/gen --window-sec 10 --step-sec 2 --timeline rppg_timeline.csv
 """
 
 
-def bandpass(signal, fs=30, low=0.7, high=4.0, order=4):
+def extract_rppg_features(aligned_dir, grid_size=4, patch_size=64, fs=30, landmarks=None):
     """
-    Apply Butterworth bandpass filter to a 1D signal.
+    From aligned frame images (or a video / .npy frame store), extract rPPG features
+    (feature vector of length P*(P-1)/2, see rppg_features.extract_features).
+    Frames are streamed; only the patch signals are kept in memory.
+    With landmarks (extract_landmarks.py output), forehead/cheek ROI masks replace the grid.
     """
-    nyq = 0.5 * fs
-    b, a = butter(order, [low/nyq, high/nyq], btype='band')
-    return filtfilt(b, a, signal)
+    sampler = RoiSampler(landmarks) if landmarks else None
+    return extract_features(open_source(aligned_dir), patch_size=patch_size, grid_size=grid_size, fs=fs,
+                            sampler=sampler)
+
+
+def check_feature_size(model, n_features):
+    expected = getattr(model, "n_features_in_", n_features)
+    if expected != n_features:
+        raise SystemExit(f"The model expects {expected} features but {n_features} were extracted "
+                         "(grid vs. --landmarks ROI mode must match the training data)")
+
+
+def _extract_one(task):
+    """ Worker: returns (features or None, error message or None) """
+    source, config, landmarks = task
+    try:
+        feats = extract_rppg_features(source, grid_size=config["grid_size"], patch_size=config["patch_size"],
+                                      fs=config["fps"], landmarks=landmarks)
+        return feats, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
 
 
-def extract_rppg_features(aligned_dir, grid_size=4, patch_size=64, fs=30):
+def resolve_landmarks(sources, specs):
     """
-    From aligned frame images, extract rPPG features:
-      - Split each frame into grid_size x grid_size patches
-      - Compute green-channel mean for each patch across frames
-      - Bandpass filter each patch signal
-      - Compute pairwise correlations between patch signals
-    Returns feature vector (length P*(P-1)/2).
+    Map each source to its landmarks .npy. A single plain path is used for a single
+    source; otherwise SOURCE=NPY pairs are expected (as in generate_rppg_features.py).
     """
-    # Collect all PNG filenames
-    files = sorted(glob.glob(f"{aligned_dir}/*.png"))
-    if not files:
-        raise FileNotFoundError(f"No aligned frames found in {aligned_dir}")
-    # Determine patch grid steps
-    img0 = cv2.imread(files[0])
-    h, w = img0.shape[:2]
-    step_y = max((h - patch_size) // (grid_size - 1), 1)
-    step_x = max((w - patch_size) // (grid_size - 1), 1)
-    P = grid_size * grid_size
-    # Initialize list for each patch signal
-    signals = [[] for _ in range(P)]
-    # Extract green-channel mean per patch per frame
-    for fn in files:
-        img = cv2.imread(fn)
-        for i in range(grid_size):
-            for j in range(grid_size):
-                y = i * step_y
-                x = j * step_x
-                patch = img[y:y+patch_size, x:x+patch_size]
-                signals[i*grid_size + j].append(patch[:, :, 1].mean())
-    # Convert to array and filter
-    signals = np.array(signals)  # shape (P, N_frames)
-    filtered = np.array([bandpass(sig, fs=fs, low=0.7, high=4.0) for sig in signals])
-    # Compute pairwise correlation features
-    feats = []
-    for i in range(P):
-        for j in range(i+1, P):
-            c = np.corrcoef(filtered[i], filtered[j])[0, 1]
-            feats.append(c)
-    return np.array(feats)
+    if not specs:
+        return {}
+    if len(sources) == 1 and len(specs) == 1 and "=" not in specs[0]:
+        return {sources[0]: specs[0]}
+    mapping = parse_landmarks(specs)
+    return {src: mapping[os.path.normpath(src)] for src in sources if os.path.normpath(src) in mapping}
+
+
+def score_sources(sources, model, landmarks=None, workers=None):
+    """
+    Extract features for every source (in parallel when there are several) and score
+    them with one vectorised predict_proba.
+    Returns a list of (source, P(real) or None, error or None) in input order.
+    """
+    config = model.config
+    landmarks = landmarks or {}
+    if config["roi"]:
+        missing = [src for src in sources if src not in landmarks]
+        if missing:
+            raise SystemExit(f"The model was trained on ROI features; no --landmarks for: {', '.join(missing)}")
+    elif landmarks:
+        raise SystemExit("The model was trained on grid features; drop --landmarks or retrain in ROI mode")
+
+    tasks = [(src, config, landmarks.get(src)) for src in sources]
+    if len(tasks) == 1 or workers == 1:
+        results = [_extract_one(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_extract_one, tasks, chunksize=1))
+
+    ok = [i for i, (feats, _) in enumerate(results) if feats is not None]
+    p_real = [None] * len(sources)
+    if ok:
+        # A constant patch has no defined correlation; treat it as uncorrelated
+        X = np.nan_to_num(np.stack([results[i][0] for i in ok]))
+        check_feature_size(model, X.shape[1])
+        for i, p in zip(ok, model.p_real(X)):
+            p_real[i] = float(p)
+    return [(src, p, err) for src, p, (_, err) in zip(sources, p_real, results)]
+
+
+def score_windows(source_path, model, window_sec, step_sec, fs=30, timeline=None, landmarks=None):
+    """
+    Stream the frames and score each sliding window as soon as it is complete.
+    Writes window,start_sec,end_sec,p_real rows to the timeline CSV and the
+    per-window feature vectors to <timeline>_features.npy.
+    Returns the list of P(real).
+    """
+    window = max(2, round(window_sec * fs))
+    step = max(1, round(step_sec * fs))
+    writer, f = None, None
+    if timeline:
+        os.makedirs(os.path.dirname(timeline) or ".", exist_ok=True)
+        f = open(timeline, "w", newline="")
+        writer = csv.writer(f)
+        writer.writerow(["window", "start_sec", "end_sec", "p_real"])
+    scores, feats = [], []
+    try:
+        sampler = RoiSampler(landmarks) if landmarks else None
+        windows = iter_window_features(open_source(source_path), window, step,
+                                       patch_size=model.config["patch_size"], grid_size=model.config["grid_size"],
+                                       fs=fs, sampler=sampler)
+        for i, (start, end, vec) in enumerate(windows):
+            if i == 0:
+                check_feature_size(model, len(vec))
+            # A constant patch has no defined correlation; treat it as uncorrelated
+            vec = np.nan_to_num(vec)
+            p_real = model.p_real(vec.reshape(1, -1))[0]
+            scores.append(p_real)
+            feats.append(vec)
+            print(f"[rPPG] window {i}: {start/fs:7.1f}s - {end/fs:7.1f}s  P(real)={p_real:.3f}")
+            if writer:
+                writer.writerow([i, f"{start/fs:.3f}", f"{end/fs:.3f}", f"{p_real:.4f}"])
+    finally:
+        if f:
+            f.close()
+    if timeline and feats:
+        np.save(os.path.splitext(timeline)[0] + "_features.npy", np.stack(feats))
+    return scores
 
 
 def main():
     parser = argparse.ArgumentParser(description="Compute rPPG Realness Score")
-    parser.add_argument("--aligned_dir", default="frames/aligned/gen",
-                        help="Directory of aligned frames to process")
-    parser.add_argument("--model", default="rppg_model.pkl",
-                        help="Path to trained logistic regression model")
+    parser.add_argument("--aligned_dir", nargs="+", default=["frames/aligned/gen"],
+                        help="Aligned frame directories to score (videos, .npy frame stores and "
+                             "directories of videos also work)")
+    parser.add_argument("--model", default=MODEL_PATH,
+                        help="Trained model (rppg_model.json; a legacy .pkl is also accepted)")
+    parser.add_argument("--landmarks", nargs="+", default=None,
+                        help="Landmarks .npy (extract_landmarks.py) for forehead/cheek ROIs; "
+                             "SOURCE=NPY pairs when scoring several sources")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Processes for feature extraction when scoring several sources")
+    parser.add_argument("--out", default=None, help="CSV of source,p_real for every source")
+    parser.add_argument("--window-sec", type=float, default=None,
+                        help="Score sliding windows of this length instead of the whole clip")
+    parser.add_argument("--step-sec", type=float, default=2.0, help="Window step in seconds")
+    parser.add_argument("--fps", type=float, default=None,
+                        help="Frame rate of the input (default: the fps the model was trained with)")
+    parser.add_argument("--timeline", default=None,
+                        help="CSV for per-window scores (features go to <timeline>_features.npy)")
     args = parser.parse_args()
 
-    # Extract features
-    feats = extract_rppg_features(args.aligned_dir)
-    # Load trained logistic regression model
-    with open(args.model, 'rb') as f:
-        model = pickle.load(f)
-    # Predict probability of being real (class 1)
-    proba = model.predict_proba(feats.reshape(1, -1))[0]
-    p_real = proba[1]
-    print(f"rPPG Realness Score: {p_real:.3f}")
+    model = load_model(args.model)
+    sources = list_samples(args.aligned_dir)
+    if not sources:
+        raise SystemExit("No sources to score")
+    landmarks = resolve_landmarks(sources, args.landmarks)
+
+    if args.window_sec:
+        if len(sources) != 1:
+            raise SystemExit("--window-sec scores a single source")
+        fps = args.fps or model.config["fps"]
+        scores = score_windows(sources[0], model, args.window_sec, args.step_sec, fps, args.timeline,
+                               landmarks.get(sources[0]))
+        if not scores:
+            print(f"rPPG: clip is shorter than one {args.window_sec:g}s window")
+            return
+        worst = int(np.argmin(scores))
+        print(f"rPPG Realness Score (windows): mean={np.mean(scores):.3f}  min={scores[worst]:.3f} "
+              f"(window {worst})  over {len(scores)} windows")
+        return
+
+    if args.fps:
+        model.config["fps"] = args.fps
+    t0 = time.perf_counter()
+    results = score_sources(sources, model, landmarks, args.workers)
+    elapsed = time.perf_counter() - t0
+
+    if len(results) == 1:
+        source, p_real, error = results[0]
+        if error:
+            raise SystemExit(f"Feature extraction failed for {source}: {error}")
+        print(f"rPPG Realness Score: {p_real:.3f}")
+        return
+
+    scored = [p for _, p, _ in results if p is not None]
+    for source, p_real, error in results:
+        if error:
+            print(f"[WARN] Skipped {source}: {error}")
+        else:
+            print(f"[rPPG] {source}: P(real)={p_real:.3f}")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["source", "p_real", "error"])
+            for source, p_real, error in results:
+                writer.writerow([source, "" if p_real is None else f"{p_real:.4f}", error or ""])
+    print(f"[rPPG] Scored {len(scored)}/{len(results)} sources in {elapsed:.1f}s "
+          f"({len(results)/elapsed:.1f} sources/s, {args.workers} workers)")
+    if scored:
+        print(f"rPPG Realness Score (mean over {len(scored)} sources): {np.mean(scored):.3f}")
+
 
 if __name__ == '__main__':
     main()
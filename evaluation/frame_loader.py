@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# frame_loader.py
+"""
+D-Score 用の先読みフレームローダー。
+
+バッチ（フレームパスの list）ごとの読み込み・デコード・前処理をスレッドプールで実行し、
+準備済みバッチを最大 max_ready 個まで先に用意しておく。消費側が追いつかなければ
+新しいバッチを投入しないので（バックプレッシャー）、メモリ使用量は一定に保たれる。
+cv2 のデコードは GIL を解放するのでスレッドで並列化できる。
+
+各ステージの稼働率を記録し、実行がデコード律速か推論律速かを report() で表示する。
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrefetchLoader:
+    def __init__(self, batches, prepare, workers=4, max_ready=8):
+        """
+        batches : バッチの iterable（prepare に渡す引数）
+        prepare : ワーカースレッドで実行する関数 prepare(batch) -> 準備済みバッチ
+        """
+        self._batches = iter(batches)
+        self._prepare = prepare
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+        self.n_batches = 0
+        self.prepare_s = 0.0   # ワーカーがデコード・前処理に使った延べ時間
+        self.wait_s = 0.0      # 消費側がバッチ待ちでブロックした時間（デコード律速の指標）
+        self.compute_s = 0.0   # 消費側がバッチを処理していた時間（推論時間）
+        self._t0 = time.perf_counter()
+        self._t_last = None
+        self._t_end = None
+
+        for _ in range(max_ready):
+            self._submit()
+
+    def _timed_prepare(self, batch):
+        t0 = time.perf_counter()
+        out = self._prepare(batch)
+        with self._lock:
+            self.prepare_s += time.perf_counter() - t0
+        return out
+
+    def _submit(self):
+        batch = next(self._batches, None)
+        if batch is not None:
+            self._pending.append(self._pool.submit(self._timed_prepare, batch))
+
+    def __iter__(self):
+        return self
+
+    def _account_compute(self):
+        """ 前回バッチを渡してからの時間を消費側の処理時間として加算 """
+        now = time.perf_counter()
+        if self._t_last is not None:
+            self.compute_s += now - self._t_last
+            self._t_last = None
+        return now
+
+    def __next__(self):
+        now = self._account_compute()
+        if not self._pending:
+            self.close()
+            raise StopIteration
+        out = self._pending.popleft().result()
+        self._t_last = time.perf_counter()
+        self.wait_s += self._t_last - now
+        # 1つ取り出したら1つ補充（先読み数は常に max_ready 以下）
+        self._submit()
+        self.n_batches += 1
+        return out
+
+    def close(self):
+        """ 途中で打ち切る場合も呼ぶ（未着手のバッチは破棄） """
+        self._t_end = self._account_compute()
+        for fut in self._pending:
+            fut.cancel()
+        self._pending.clear()
+        self._pool.shutdown(wait=True)
+
+    def report(self, name):
+        wall = max((self._t_end or time.perf_counter()) - self._t0, 1e-9)
+        decode_busy = self.prepare_s / (wall * self.workers)
+        compute = self.compute_s / wall
+        wait = self.wait_s / wall
+        bound = "decode-bound" if wait > 0.1 else "compute-bound"
+        print(f"[Loader] {name}: {self.n_batches} batches in {wall:.1f}s  "
+              f"compute {compute*100:.0f}%  waiting for frames {wait*100:.0f}%  "
+              f"decode workers busy {decode_busy*100:.0f}% ({self.workers} threads) -> {bound}")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# i3d_extractor.py
+"""
+FVD 用の I3D 特徴抽出器（ネットワーク不要・キャッシュ付き）。
+
+  - チェックポイント: キャッシュの I3D_8x8_R50.pyth（PyTorchVideo の Kinetics-400 I3D R50）
+    ダウンロードやコピーしたファイルは、固定した sha256（CHECKPOINT_SHA256 / $FVD_I3D_SHA256 /
+    --checkpoint-sha256）と一致し、中身（model_state）を読めるときだけ使う。固定値が無い・一致しない
+    ファイルは --trust-checkpoint を明示しない限り拒否する（最初に見たファイルを信用することはしない）。
+    sha256 はサイズ・更新時刻と一緒にスタンプ（I3D_8x8_R50.pyth.stamp）に記録し、
+    以降はファイルが変わっていない限り再ハッシュせずに固定値と照合する。
+  - 分類ヘッドを外した headless モデル（blocks[:-1] → 時間＋空間で平均 → (B, 2048)）を
+    一度だけ trace → freeze してキャッシュに保存し、次回からはそれを読み込むだけにする。
+
+ネットワークに接続するのは --allow-download を指定してチェックポイントが無いときだけ。
+オフラインのノードでは、チェックポイントをキャッシュへコピーしておけばよい。
+
+precision="bf16" では freeze していない headless モデルを channels_last_3d に変換し、
+bfloat16 の autocast で実行する（AVX512-BF16 / AMX など bf16 対応 CPU 向け）。
+
+Usage（キャッシュの準備）:
+    python evaluation/i3d_extractor.py --allow-download
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import torch
+from torch import nn
+
+CHECKPOINT = "I3D_8x8_R50.pyth"
+CHECKPOINT_URL = "https://dl.fbaipublicfiles.com/pytorchvideo/model_zoo/kinetics/I3D_8x8_R50.pyth"
+CACHE_ENV = "FVD_I3D_CACHE"
+SHA256_ENV = "FVD_I3D_SHA256"
+# 公開チェックポイントの sha256（モデルズーには掲載されていないので、確認した値をここか $FVD_I3D_SHA256 で固定する）
+CHECKPOINT_SHA256 = None
+FEATURE_DIM = 2048
+CLIP_LEN = 16
+CROP_SIZE = 224
+PRECISIONS = ("fp32", "bf16")
+
+
+def default_cache_dir():
+    return os.environ.get(
+        CACHE_ENV,
+        os.path.join(os.path.expanduser("~"), ".cache", "evaluate_maked_video", "i3d"),
+    )
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class I3DFeatures(nn.Module):
+    """ 分類ヘッドを除いた I3D。出力はプーリング特徴 (B, 2048) """
+    def __init__(self, blocks):
+        super().__init__()
+        self.blocks = nn.ModuleList(blocks)
+
+    def forward(self, x):
+        for blk in self.blocks:
+            x = blk(x)
+        return x.mean(dim=[2, 3, 4])
+
+
+class AutocastI3D(nn.Module):
+    """ headless I3D を channels_last_3d + bfloat16 autocast で実行し、特徴は float32 で返す """
+    def __init__(self, model, device_type):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last_3d)
+        self.device_type = device_type
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last_3d)
+        with torch.autocast(self.device_type, dtype=torch.bfloat16):
+            return self.model(x).float()
+
+
+def bf16_supported(device):
+    """ bf16 の行列演算をネイティブに実行できるか（CPU は oneDNN の判定を使う） """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _load_checkpoint(path):
+    try:
+        # 学習設定などテンソル以外も含むので weights_only は使えない（検査・照合済みのファイルに限る）
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location="cpu")
+
+
+def expected_sha256(sha256=None):
+    """ 固定する sha256（引数 → $FVD_I3D_SHA256 → CHECKPOINT_SHA256 の順）。無ければ None """
+    pin = sha256 or os.environ.get(SHA256_ENV) or CHECKPOINT_SHA256
+    return pin.strip().lower() if pin else None
+
+
+def check_pinned(path, digest, expected, trust=False):
+    """ digest を固定値 expected と照合する。一致しない・固定値が無い場合は trust=True でなければ拒否 """
+    if expected and digest == expected:
+        return
+    if expected:
+        problem = f"Checksum mismatch for {path} (expected {expected}, got {digest})"
+    else:
+        problem = (f"No pinned sha256 for {CHECKPOINT}; set {SHA256_ENV} (or --checkpoint-sha256) to the "
+                   f"published digest. {path} has sha256={digest}")
+    if not trust:
+        raise ValueError(f"{problem}. Pass --trust-checkpoint to use this file anyway.")
+    print(f"[I3D] WARNING: {problem}; using it because --trust-checkpoint was given")
+
+
+def verify_checkpoint(path, expected=None, trust=False):
+    """
+    ファイルを信用する前の検査: 固定値 expected と照合し（check_pinned）、途中で切れたファイルや
+    別物でないことを中身（model_state のテンソル）を読んで確かめる。return: sha256
+    """
+    digest = file_sha256(path)
+    check_pinned(path, digest, expected, trust)
+    try:
+        state = _load_checkpoint(path)["model_state"]
+        if not state or not all(isinstance(v, torch.Tensor) for v in state.values()):
+            raise ValueError("model_state has no tensors")
+    except Exception as e:
+        raise ValueError(f"{path} is not a valid {CHECKPOINT} checkpoint (truncated or corrupted?): {e}") from e
+    return digest
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def checkpoint_path(cache_dir=None, allow_download=False, sha256=None, trust=False):
+    """
+    キャッシュのチェックポイントのパスと sha256 を返す。
+    サイズ・更新時刻がスタンプと一致すれば記録済みの sha256 を固定値と照合するだけ（再ハッシュしない）、
+    そうでなければ verify_checkpoint で検査してスタンプを書き直す。
+    sha256: 固定値（省略時は expected_sha256()）。trust=True なら固定値が無い・一致しなくても使う。
+    return: (チェックポイントのパス, sha256)
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    path = os.path.join(cache_dir, CHECKPOINT)
+    stamp_path = path + ".stamp"
+    expected = expected_sha256(sha256)
+    if not os.path.exists(path):
+        if not allow_download:
+            raise FileNotFoundError(
+                f"I3D checkpoint {CHECKPOINT} not found in {cache_dir}. Copy it there (or set {CACHE_ENV}), "
+                f"or pass --allow-download to fetch it from {CHECKPOINT_URL}."
+            )
+        os.makedirs(cache_dir, exist_ok=True)
+        print(f"[I3D] Downloading {CHECKPOINT_URL}")
+        tmp = path + ".tmp"
+        torch.hub.download_url_to_file(CHECKPOINT_URL, tmp)
+        try:
+            verify_checkpoint(tmp, expected, trust)
+        except ValueError:
+            os.remove(tmp)
+            raise
+        os.replace(tmp, path)
+
+    key = _stat_key(path)
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            stamp = json.load(f)
+        if {k: stamp.get(k) for k in key} == key:
+            check_pinned(path, stamp["sha256"], expected, trust)
+            return path, stamp["sha256"]
+
+    digest = verify_checkpoint(path, expected, trust)
+    with open(stamp_path, "w") as f:
+        json.dump({**key, "sha256": digest}, f)
+    return path, digest
+
+
+def build_headless(ckpt_path):
+    """ チェックポイントの重みで I3D R50 を構築し、分類ヘッドを外す """
+    from pytorchvideo.models.hub import i3d_r50
+    model = i3d_r50(pretrained=False)
+    model.load_state_dict(_load_checkpoint(ckpt_path)["model_state"])
+    return I3DFeatures(list(model.blocks[:-1])).eval()
+
+
+def _freeze(model, path):
+    """ trace → freeze して path に保存（一時ファイル経由で書き込む） """
+    example = torch.zeros(1, 3, CLIP_LEN, CROP_SIZE, CROP_SIZE)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(model, example))
+    tmp = path + ".tmp"
+    torch.jit.save(frozen, tmp)
+    os.replace(tmp, path)
+    return frozen
+
+
+def load_i3d(device="cpu", cache_dir=None, allow_download=False, frozen=True, precision="fp32",
+             sha256=None, trust=False):
+    """
+    headless I3D を返す（入力 (B, 3, T, 224, 224) → 出力 (B, 2048)）。
+    frozen=True ならキャッシュの TorchScript を読み込み、無ければ作成して保存する。
+    precision="bf16" は eager モデルを AutocastI3D で包んで返す（非対応なら ValueError）。
+    sha256 / trust はチェックポイントの照合（checkpoint_path）に渡す。
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision} (choose from {PRECISIONS})")
+    cache_dir = cache_dir or default_cache_dir()
+    ckpt, digest = checkpoint_path(cache_dir, allow_download, sha256, trust)
+    if precision == "bf16":
+        if not bf16_supported(device):
+            raise ValueError(f"bfloat16 is not supported natively on this {torch.device(device).type} device")
+        return AutocastI3D(build_headless(ckpt).to(device), torch.device(device).type).eval()
+    if not frozen:
+        return build_headless(ckpt).to(device)
+    frozen_path = os.path.join(cache_dir, f"i3d_headless_{digest[:16]}.ts.pt")
+    if not os.path.exists(frozen_path):
+        print(f"[I3D] Tracing headless model -> {frozen_path}")
+        _freeze(build_headless(ckpt), frozen_path)
+    return torch.jit.load(frozen_path, map_location=device).eval()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Prepare the cached, frozen I3D feature extractor for FVD")
+    ap.add_argument("--cache-dir", default=None, help=f"I3D cache (default: ${CACHE_ENV} or ~/.cache)")
+    ap.add_argument("--allow-download", action="store_true", help="Fetch the checkpoint if it is not cached")
+    ap.add_argument("--checkpoint-sha256", default=None,
+                    help=f"Expected sha256 of {CHECKPOINT} (default: ${SHA256_ENV} or the pinned value)")
+    ap.add_argument("--trust-checkpoint", action="store_true",
+                    help="Use the checkpoint even if no sha256 is pinned or it does not match")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    ckpt, digest = checkpoint_path(args.cache_dir, args.allow_download, args.checkpoint_sha256,
+                                   args.trust_checkpoint)
+    print(f"[I3D] {ckpt}  sha256={digest[:12]}")
+    pin = dict(sha256=args.checkpoint_sha256, trust=args.trust_checkpoint)
+    load_i3d("cpu", args.cache_dir, **pin)
+    cold = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    load_i3d("cpu", args.cache_dir, **pin)
+    print(f"[I3D] prepare {cold:.1f}s  reload from cache {time.perf_counter()-t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
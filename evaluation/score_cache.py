@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# score_cache.py
+"""
+D-Score 用の検出器スコアキャッシュ（SQLite）。
+
+キー: (アライン済みフレームのファイル内容ハッシュ, 検出器キー)
+  - フレームハッシュ: PNG バイト列の blake2b（デコード前に計算できる）
+  - 検出器キー      : 重みの sha256 + 量子化モード（fp32 / dynamic / static）+ 推論バックエンド
+                      static は較正セット（実写フレーム or --calib）の内容ハッシュも含める
+値: その検出器の P(real)
+
+同じ実写動画を生成動画ごとに何度も評価しても、2回目以降は実写側の推論が不要になる。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+import cv2
+import numpy as np
+
+from detector_backends import weight_hash
+
+# SQLite の IN 句に渡すパラメータ数の上限を超えないように分割する
+_CHUNK = 500
+
+
+def frame_key(data: bytes):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def detector_key(det):
+    quant = getattr(det, 'quantized', None) or 'fp32'
+    if quant == "static":
+        quant += f"@{det.calib_hash}"
+    return f"{weight_hash(det)}:{quant}:{getattr(det, 'backend', None) or 'eager'}"
+
+
+def read_frames(paths):
+    """ return: (ファイル内容の list, フレームハッシュの list) """
+    blobs = []
+    for fn in paths:
+        with open(fn, "rb") as f:
+            blobs.append(f.read())
+    return blobs, [frame_key(b) for b in blobs]
+
+
+def decode_frame(blob):
+    """ ファイル内容から BGR 画像へデコード（cv2.imread と同じ結果） """
+    return cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class ScoreCache:
+    def __init__(self, path, detectors):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.det_keys = [detector_key(det) for det in detectors]
+        # シャード並列時に複数プロセスから書き込めるよう WAL + 待ち時間を設定。
+        # 先読みローダーのワーカースレッドからも照合するので接続はロックで保護する
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            " frame TEXT NOT NULL, detector TEXT NOT NULL, prob REAL NOT NULL,"
+            " PRIMARY KEY (frame, detector)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, keys):
+        """ return: (len(keys), 検出器数) の確率配列。未キャッシュは NaN """
+        out = np.full((len(keys), len(self.det_keys)), np.nan, dtype=np.float32)
+        row = {k: i for i, k in enumerate(keys)}
+        with self.lock:
+            for j, dk in enumerate(self.det_keys):
+                for start in range(0, len(keys), _CHUNK):
+                    chunk = keys[start:start+_CHUNK]
+                    q = ("SELECT frame, prob FROM scores WHERE detector = ? AND frame IN "
+                         f"({','.join('?' * len(chunk))})")
+                    for frame, prob in self.conn.execute(q, [dk, *chunk]):
+                        out[row[frame], j] = prob
+            found = ~np.isnan(out)
+            self.hits += int(found.sum())
+            self.misses += int((~found).sum())
+        return out
+
+    def store(self, keys, probs, mask):
+        """ probs[i, j] を mask[i, j] が True の要素だけ書き込む """
+        rows = [(keys[i], self.det_keys[j], float(probs[i, j])) for i, j in zip(*np.nonzero(mask))]
+        if rows:
+            with self.lock:
+                self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?)", rows)
+                self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -117,8 +117,6 @@ def create_directories():
         "frames/raw/gen", 
         "frames/aligned/real",
         "frames/aligned/gen",
-        "clips/real",
-        "clips/gen",
         "landmarks",
         "features",
         "features_tmp",
@@ -305,35 +303,29 @@ def main():
             "10. シフト後のシーケンス特徴抽出"
         )
         
-        if not args.skip_fvd:
-            run_command(
-                f"{python_cmd} preprocessing/clip_split.py",
-                "11. FVD用クリップ生成"
-            )
-        
         # ==========================================
         # 5. モデル準備・学習（オプション）
         # ==========================================
         if not args.skip_models:
             run_command(
                 f"{python_cmd} training/generate_detectors.py",
-                "12. Deepfake検出器生成"
+                "11. Deepfake検出器生成"
             )
             
             run_command(
                 f"{python_cmd} training/train_detectors.py",
-                "13. Deepfake検出器学習"
+                "12. Deepfake検出器学習"
             )
             
             run_command(
-                f"{python_cmd} utils/prepare_rppg_dataset.py --input-dir features --output-features training/X_train.npy --output-labels training/y_train.npy",
-                "14. rPPG特徴量/ラベルデータ作成",
+                f"{python_cmd} training/generate_rppg_features.py --real_dir frames/aligned/real --gen_dir frames/aligned/gen --segment-sec 10 --out_features training/X_train.npy --out_labels training/y_train.npy",
+                "13. rPPG特徴量/ラベルデータ作成",
                 check=False
             )
             
             run_command(
                 f"{python_cmd} training/generate_rppg_model.py --features training/X_train.npy --labels training/y_train.npy",
-                "15. rPPGモデル学習",
+                "14. rPPGモデル学習",
                 check=False
             )
         else:
@@ -346,42 +338,42 @@ def main():
         
         if not args.skip_fvd:
             run_command(
-                f"{python_cmd} evaluation/compute_fvd.py",
-                "16. FVD計算（10-20分かかります）"
+                f"{python_cmd} evaluation/compute_fvd.py --real frames/aligned/real --gen frames/aligned/gen --allow-download",
+                "15. FVD計算（10-20分かかります）"
             )
         else:
             print("\n⏭️  FVD計算をスキップしました")
         
         run_command(
             f"{python_cmd} evaluation/compute_nme.py --real landmarks/real.npy --gen landmarks/gen.npy",
-            "17. NME計算"
+            "16. NME計算"
         )
         
         run_command(
-            f'{python_cmd} evaluation/compute_dscore.py --detectors detectors.pkl --real "frames/aligned/real/*.png" --gen "frames/aligned/gen/*.png"',
-            "18. D-Score計算（3分程度）",
+            f'{python_cmd} evaluation/compute_dscore.py --detectors detectors.json --real "frames/aligned/real/*.png" --gen "frames/aligned/gen/*.png"',
+            "17. D-Score計算（3分程度）",
             check=False
         )
         
         run_command(
             f"{python_cmd} evaluation/compute_dtw.py --real features/real.npy --gen features/gen.npy",
-            "19. DTW正規化距離計算"
+            "18. DTW正規化距離計算"
         )
         
         run_command(
             f"{python_cmd} evaluation/compute_pseudo_au.py --real landmarks/real.npy --gen landmarks/gen.npy",
-            "20. Pseudo-AU NME計算"
+            "19. Pseudo-AU NME計算"
         )
         
         run_command(
             f"{python_cmd} evaluation/compute_au_mae.py",
-            "21. AU MAE計算（オプション）",
+            "20. AU MAE計算（オプション）",
             check=False
         )
         
         run_command(
-            f"{python_cmd} evaluation/compute_rppg.py --aligned_dir frames/aligned/gen --model rppg_model.pkl",
-            "22. rPPGスコア計算",
+            f"{python_cmd} evaluation/compute_rppg.py --aligned_dir frames/aligned/gen --model rppg_model.json",
+            "21. rPPGスコア計算",
             check=False
         )
         
@@ -402,7 +394,6 @@ def main():
         print("   - frames/: フレーム画像")
         print("   - landmarks/: 顔ランドマークデータ")
         print("   - features/: シーケンス特徴量")
-        print("   - clips/: FVD用クリップ")
         
     except KeyboardInterrupt:
         print("\n\n⏹️  処理が中断されました")
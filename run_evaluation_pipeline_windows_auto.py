@@ -204,8 +204,6 @@ def create_directories():
         "frames/raw/gen", 
         "frames/aligned/real",
         "frames/aligned/gen",
-        "clips/real",
-        "clips/gen",
         "landmarks",
         "features",
         "features_tmp",
@@ -331,9 +329,6 @@ def main():
         run_command(f"{python_cmd} preprocessing/extract_sequence_features.py --aligned_real frames/aligned/real --aligned_gen frames/aligned/gen --out_dir features",
                    "10. シフト後特徴量抽出")
         
-        if not args.skip_fvd:
-            run_command(f"{python_cmd} preprocessing/clip_split.py", "11. FVD用クリップ生成")
-        
         # 評価指標計算（簡略版）
         print("\n📊 評価指標の計算...")
         
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# detector_backends.py
+"""
+Deepfake 検出器の推論バックエンド。
+
+  - eager       : 通常の PyTorch（基準）
+  - torchscript : trace → freeze したモデル
+  - compile     : torch.compile（Inductor）
+  - onnx        : ONNX にエクスポートして onnxruntime で実行
+
+コンパイル済みの成果物はディスクにキャッシュする。torchscript / onnx は重みの sha256 と入力サイズを
+ファイル名にし（torchscript は trace したバッチサイズ・デバイス・torch のバージョンも含める）、compile は全検出器で共通の Inductor キャッシュ（<cache>/inductor）を使う
+（Inductor のキャッシュはグラフで引かれるので、重みごとに分ける必要はない）。
+
+Usage（各バックエンドの一致確認とスループット計測）:
+    python training/detector_backends.py --detectors detectors.json --frames "frames/aligned/real/*.png"
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from detectors import DEVICE, SharedPreprocessor
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+CACHE_ENV = "DSCORE_COMPILE_CACHE"
+
+
+def default_cache_dir():
+    return os.environ.get(
+        CACHE_ENV,
+        os.path.join(os.path.expanduser("~"), ".cache", "evaluate_maked_video", "compiled"),
+    )
+
+
+def weight_hash(det):
+    """ レジストリの sha256 を使う。旧形式の検出器は state_dict から計算する """
+    if getattr(det, "weight_hash", None):
+        return det.weight_hash
+    h = hashlib.sha256()
+    for k, v in det.model.state_dict().items():
+        h.update(k.encode())
+        h.update(v.detach().cpu().contiguous().numpy().tobytes())
+    det.weight_hash = h.hexdigest()
+    return det.weight_hash
+
+
+def _example_input(det, batch_size):
+    return torch.randn(batch_size, 3, det.input_size, det.input_size, device=DEVICE) \
+                .contiguous(memory_format=torch.channels_last)
+
+
+class OnnxRunner:
+    """ onnxruntime のセッションを torch テンソルの入出力で呼べるようにする """
+    def __init__(self, path):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        out = self.session.run(None, {self.input_name: x.detach().cpu().contiguous().numpy()})[0]
+        return torch.from_numpy(out).to(x.device)
+
+
+def _build_torchscript(det, path, batch_size):
+    if os.path.exists(path):
+        return torch.jit.load(path, map_location=DEVICE)
+    model = det.model.to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, _example_input(det, batch_size))
+        frozen = torch.jit.freeze(traced)
+    tmp = path + ".tmp"
+    torch.jit.save(frozen, tmp)
+    os.replace(tmp, path)
+    return frozen
+
+
+def _build_compile(det, inductor_dir):
+    # Inductor はこの環境変数を初回の forward で読む（torch.compile は遅延実行）。
+    # 検出器ごとに変えると最後の値が全検出器に使われるので、共通のディレクトリを指す
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = inductor_dir
+    model = det.model.to(memory_format=torch.channels_last)
+    return torch.compile(model)
+
+
+def _build_onnx(det, path, batch_size):
+    if not os.path.exists(path):
+        tmp = path + ".tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                det.model, _example_input(det, batch_size), tmp,
+                input_names=["input"], output_names=["logit"],
+                dynamic_axes={"input": {0: "batch"}, "logit": {0: "batch"}},
+                opset_version=17,
+            )
+        os.replace(tmp, path)
+    return OnnxRunner(path)
+
+
+def build_runner(det, backend, cache_dir=None, batch_size=16):
+    """ det.model をバックエンドに応じて変換した呼び出し可能オブジェクトを返す """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend} (choose from {BACKENDS})")
+    if backend == "eager":
+        return det.model
+
+    cache_dir = cache_dir or default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    key = f"{weight_hash(det)}_{det.input_size}"
+    if backend == "torchscript":
+        # trace はバッチサイズ・デバイスを固定して記録され、形式は torch のバージョンに依存する
+        ts_key = f"{key}_b{batch_size}_{DEVICE.type}_torch{torch.__version__}"
+        return _build_torchscript(det, os.path.join(cache_dir, f"{ts_key}.ts.pt"), batch_size)
+    if backend == "compile":
+        inductor_dir = os.path.join(cache_dir, "inductor")
+        os.makedirs(inductor_dir, exist_ok=True)
+        return _build_compile(det, inductor_dir)
+    return _build_onnx(det, os.path.join(cache_dir, f"{key}.onnx"), batch_size)
+
+
+def check_parity(det, x, backend, cache_dir=None):
+    """ eager との出力確率の最大絶対誤差を返す """
+    det.set_backend("eager")
+    ref = det.predict_batch(x)
+    det.set_backend(backend, cache_dir, x.shape[0])
+    out = det.predict_batch(x)
+    return float(np.abs(out - ref).max())
+
+
+def benchmark(det, x, backend, cache_dir=None, iters=10, warmup=2):
+    """ return: (バックエンド構築秒, frames/s) """
+    t0 = time.perf_counter()
+    det.set_backend(backend, cache_dir, x.shape[0])
+    for _ in range(warmup):
+        det.predict_batch(x)
+    build_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        det.predict_batch(x)
+    return build_s, iters * x.shape[0] / (time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Parity and throughput report for detector backends")
+    ap.add_argument("--detectors", default="detectors.json", help="Detector registry")
+    ap.add_argument("--frames", default="frames/aligned/real/*.png", help="Glob for sample frames")
+    ap.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--iters", type=int, default=10)
+    ap.add_argument("--cache-dir", default=None, help=f"Compiled artifact cache (default: ${CACHE_ENV} or ~/.cache)")
+    args = ap.parse_args()
+
+    from detector_registry import load_registry
+    detectors = load_registry(args.detectors)
+
+    paths = sorted(glob.glob(args.frames))[:args.batch_size]
+    if paths:
+        imgs = [cv2.imread(p) for p in paths]
+    else:
+        print(f"[Backend] No frames match {args.frames}; using random input")
+        imgs = list(np.random.randint(0, 256, (args.batch_size, 256, 256, 3), dtype=np.uint8))
+    inputs = SharedPreprocessor([det.input_size for det in detectors])(imgs)
+
+    for det in detectors:
+        x = inputs[det.input_size].clone()
+        print(f"\n[{det.name}] batch={x.shape[0]}  input={det.input_size}")
+        for backend in args.backends:
+            try:
+                diff = check_parity(det, x, backend, args.cache_dir)
+                build_s, fps = benchmark(det, x, backend, args.cache_dir, args.iters)
+            except Exception as e:
+                print(f"  {backend:12s} unavailable: {e}")
+                continue
+            print(f"  {backend:12s} max|Δp|={diff:.2e}  build={build_s:6.2f}s  {fps:8.1f} frames/s")
+        det.set_backend("eager")
+
+
+if __name__ == "__main__":
+    main()
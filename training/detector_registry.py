@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# detector_registry.py
+"""
+Deepfake 検出器レジストリ。
+
+検出器オブジェクト全体を pickle する代わりに、
+  - detectors.json : 各検出器の構成（名前・アーキテクチャ・入力サイズ・重みの sha256）
+  - 重みファイル   : state_dict（safetensors があれば .safetensors、なければ .pt）
+に分けて保存する。重みはローカルキャッシュ（sha256 をファイル名とする）から
+メモリマップで読み込むだけで、ネットワークには一切アクセスしない。
+
+Usage（旧形式 detectors.pkl からの移行）:
+    python training/detector_registry.py --from-pkl detectors.pkl --out detectors.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+
+import torch
+
+from detectors import BaseDetector, create_backbone
+
+REGISTRY_PATH = "detectors.json"
+REGISTRY_VERSION = 1
+# 重みキャッシュの場所は環境変数で上書きできる
+CACHE_ENV = "DSCORE_WEIGHT_CACHE"
+
+
+def default_cache_dir():
+    return os.environ.get(
+        CACHE_ENV,
+        os.path.join(os.path.expanduser("~"), ".cache", "evaluate_maked_video", "detectors"),
+    )
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _has_safetensors():
+    try:
+        import safetensors.torch  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def save_state_dict(state_dict, cache_dir=None):
+    """
+    state_dict をキャッシュへ保存する。
+    return: (sha256, キャッシュ内のファイル名)
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+    ext = ".safetensors" if _has_safetensors() else ".pt"
+
+    # 一時ファイルに書いてからハッシュ名へ rename（途中で落ちても壊れたファイルを残さない）
+    fd, tmp = tempfile.mkstemp(suffix=ext, dir=cache_dir)
+    os.close(fd)
+    try:
+        if ext == ".safetensors":
+            from safetensors.torch import save_file
+            save_file(state_dict, tmp)
+        else:
+            torch.save(state_dict, tmp)
+        digest = file_sha256(tmp)
+        fname = digest + ext
+        os.replace(tmp, os.path.join(cache_dir, fname))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return digest, fname
+
+
+def load_state_dict(path):
+    """ 重みファイルをメモリマップで読み込む """
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(path, device="cpu")
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:  # torch < 2.1 は mmap 非対応
+        return torch.load(path, map_location="cpu")
+
+
+def resolve_weight(entry, registry_path, cache_dir=None):
+    """ キャッシュ → レジストリと同じディレクトリ の順で重みファイルを探す """
+    cache_dir = cache_dir or default_cache_dir()
+    candidates = [
+        os.path.join(cache_dir, entry["weights"]),
+        os.path.join(os.path.dirname(os.path.abspath(registry_path)), entry["weights"]),
+    ]
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(
+        f"Weights for {entry['name']} ({entry['weights']}) not found in {cache_dir}. "
+        f"Copy the file into the cache or set {CACHE_ENV}."
+    )
+
+
+def save_registry(detectors, registry_path=REGISTRY_PATH, cache_dir=None):
+    """ 検出器の重みをキャッシュへ保存し、構成を registry_path に書き出す """
+    entries = []
+    for det in detectors:
+        digest, fname = save_state_dict(det.model.state_dict(), cache_dir)
+        det.weight_hash = digest
+        entries.append({
+            "name": det.name,
+            "arch": det.model_name,
+            "input_size": det.input_size,
+            "num_classes": det.num_classes,
+            "weights": fname,
+            "sha256": digest,
+        })
+    with open(registry_path, "w") as f:
+        json.dump({"version": REGISTRY_VERSION, "detectors": entries}, f, indent=2)
+    return entries
+
+
+def load_registry(registry_path=REGISTRY_PATH, cache_dir=None, verify=False):
+    """
+    registry_path の構成に従い、事前学習重みなしでモデルを構築してから
+    キャッシュの state_dict を読み込む。verify=True なら sha256 を検証する。
+    """
+    with open(registry_path) as f:
+        config = json.load(f)
+    if config.get("version") != REGISTRY_VERSION:
+        raise ValueError(f"Unsupported registry version: {config.get('version')}")
+
+    detectors = []
+    for entry in config["detectors"]:
+        path = resolve_weight(entry, registry_path, cache_dir)
+        if verify and file_sha256(path) != entry["sha256"]:
+            raise ValueError(f"Checksum mismatch for {path}")
+
+        model = create_backbone(entry["arch"], entry["num_classes"], pretrained=False)
+        state_dict = load_state_dict(path)
+        try:
+            # assign=True ならメモリマップ済みテンソルをそのままパラメータにする
+            model.load_state_dict(state_dict, assign=True)
+        except TypeError:  # torch < 2.1
+            model.load_state_dict(state_dict)
+
+        det = BaseDetector(entry["arch"], entry["input_size"], entry["num_classes"],
+                           pretrained=False, model=model)
+        det.name = entry["name"]
+        det.weight_hash = entry["sha256"]
+        detectors.append(det)
+    return detectors
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Convert a pickled detectors.pkl into a detector registry")
+    ap.add_argument("--from-pkl", default="detectors.pkl", help="Pickled detector list")
+    ap.add_argument("--out", default=REGISTRY_PATH, help="Output registry JSON")
+    ap.add_argument("--cache-dir", default=None, help=f"Weight cache (default: ${CACHE_ENV} or ~/.cache)")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    with open(args.from_pkl, "rb") as f:
+        detectors = pickle.load(f)
+    for det in detectors:
+        # 旧バージョンの pickle には構成情報が無いので timm のモデル設定から補う
+        det.name = getattr(det, "name", type(det).__name__)
+        det.model_name = getattr(det, "model_name", det.model.default_cfg["architecture"])
+        det.input_size = getattr(det, "input_size", det.transform.transforms[1].size[0])
+        det.num_classes = getattr(det, "num_classes", det.model.num_classes)
+    entries = save_registry(detectors, args.out, args.cache_dir)
+    for e in entries:
+        print(f"[Registry] {e['name']}: {e['arch']} @ {e['input_size']}  sha256={e['sha256'][:12]}")
+    print(f"[Registry] Wrote {args.out} in {time.perf_counter()-t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,11 @@
 # detectors.py
 
+import hashlib
+
 import cv2
+import numpy as np
 import torch
-import timm
-import torchvision.transforms as T
-from PIL import Image
+import torch.nn.functional as F
 
 #――――――――――――――――――――――――――
 # 前処理／デバイス設定用定数
@@ -19,22 +20,37 @@ DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 #――――――――――――――――――――――――――
 # ベースクラス（Optional）
 #――――――――――――――――――――――――――
+def create_backbone(model_name: str, num_classes: int = 1, pretrained: bool = False):
+    """ timm バックボーンを生成（timm はここで初めて import する） """
+    import timm
+    return timm.create_model(model_name, pretrained=pretrained, num_classes=num_classes)
+
 class BaseDetector:
     def __init__(self, model_name: str, input_size: int, num_classes: int = 1,
-                 pretrained: bool = True, weight_path: str = None):
-        # モデル生成
-        self.model = timm.create_model(
-            model_name,
-            pretrained=pretrained,
-            num_classes=num_classes
-        ).to(DEVICE).eval()
+                 pretrained: bool = True, weight_path: str = None, model=None):
+        self.name = type(self).__name__
+        self.model_name = model_name
+        self.input_size = input_size
+        self.num_classes = num_classes
+        # 重みファイルの sha256（detector_registry 経由で保存・ロードした場合に設定）
+        self.weight_hash = None
+
+        # モデル生成（カスタム重みを読む場合は事前学習重みのダウンロードは不要）
+        if model is None:
+            model = create_backbone(model_name, num_classes,
+                                    pretrained=pretrained and weight_path is None)
+        self.model = model.to(DEVICE).eval()
+        self.device = DEVICE
+        # int8 量子化モード（None / "dynamic" / "static"、quantize_detector で設定）
+        self.quantized = None
 
         # カスタム重みがあればロード
         if weight_path is not None:
             state_dict = torch.load(weight_path, map_location=DEVICE)
             self.model.load_state_dict(state_dict)
 
-        # 前処理パイプライン
+        # 前処理パイプライン（PIL 経由の従来経路）
+        import torchvision.transforms as T
         self.transform = T.Compose([
             T.Resize(input_size),
             T.CenterCrop(input_size),
@@ -47,6 +63,8 @@ class BaseDetector:
         img: BGR numpy array (H, W, 3)
         return: Fake と判断する確率（0〜1）
         """
+        from PIL import Image
+
         # BGR→RGB→PIL→Tensor
         rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         x = self.transform(Image.fromarray(rgb)) \
@@ -58,33 +76,212 @@ class BaseDetector:
             prob  = torch.sigmoid(logit)[0].item()
         return prob
 
+    def set_backend(self, backend: str = "eager", cache_dir: str = None, batch_size: int = 16):
+        """
+        predict_batch の推論バックエンドを切り替える
+        （eager / torchscript / compile / onnx、詳細は detector_backends.py）
+        """
+        from detector_backends import build_runner
+        if getattr(self, "quantized", None) and backend != "eager":
+            raise ValueError("Quantized detectors only support the eager backend")
+        self.backend = backend
+        self.runner = None if backend == "eager" else build_runner(self, backend, cache_dir, batch_size)
+
+    def predict_batch(self, x):
+        """
+        x: SharedPreprocessor が返す正規化済みテンソル (N, 3, input_size, input_size)
+        return: 各フレームの確率 (N,) numpy 配列
+        """
+        runner = getattr(self, "runner", None) or self.model
+        x = x.to(getattr(self, "device", DEVICE))
+        with torch.no_grad():
+            logit = runner(x)
+            prob  = torch.sigmoid(logit).view(-1)
+        return prob.float().cpu().numpy()
+
+#――――――――――――――――――――――――――
+# テンソルネイティブな共有前処理
+#――――――――――――――――――――――――――
+class SharedPreprocessor:
+    """
+    uint8 の BGR バッチを一度だけ float テンソル（channels-last）に変換し、
+    各検出器の入力サイズへ一括でリサイズ・センタークロップ・正規化する。
+    T.Resize(size) + T.CenterCrop(size) + T.Normalize と同じ処理を
+    antialias 付き bilinear 補間で行う（PIL 経由の結果と許容誤差内で一致）。
+
+    出力テンソルは事前確保したバッファのビューで、次の呼び出しで上書きされる。
+    """
+    def __init__(self, input_sizes, device=DEVICE):
+        self.input_sizes = sorted(set(input_sizes))
+        self.device = device
+        self.mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1)
+        self.std  = torch.tensor(STD,  device=device).view(1, 3, 1, 1)
+        self._buffers = {}
+
+    def _buffer(self, size, n):
+        buf = self._buffers.get(size)
+        if buf is None or buf.shape[0] < n:
+            buf = torch.empty((n, 3, size, size), device=self.device) \
+                      .contiguous(memory_format=torch.channels_last)
+            self._buffers[size] = buf
+        return buf[:n]
+
+    @staticmethod
+    def prepare(imgs):
+        """ BGR uint8 画像の list → 連続した RGB uint8 配列 (N, H, W, 3)（torch を使わないのでスレッドで実行可） """
+        return np.ascontiguousarray(np.stack(imgs)[..., ::-1])  # BGR→RGB
+
+    def to_float(self, imgs, prepared=False):
+        """
+        imgs: BGR uint8 のバッチ (N, H, W, 3) またはその list
+              （prepared=True なら prepare() 済みの RGB 配列）
+        return: RGB, [0, 1] の float テンソル (N, 3, H, W)（channels-last）
+        """
+        batch = imgs if prepared else self.prepare(imgs)
+        # NHWC のまま permute するので channels-last のストライドになる
+        x = torch.from_numpy(batch).to(self.device).permute(0, 3, 1, 2)
+        return x.float().div_(255.0)
+
+    def resize_normalize(self, x, size):
+        """ float バッチ x を 短辺 size にリサイズ → size×size クロップ → 正規化 """
+        n, _, h, w = x.shape
+        # T.Resize(size) と同じく短辺を size に合わせ、長辺は切り捨て
+        if h <= w:
+            new_h, new_w = size, int(size * w / h)
+        else:
+            new_h, new_w = int(size * h / w), size
+        if (new_h, new_w) != (h, w):
+            x = F.interpolate(x, size=(new_h, new_w), mode='bilinear',
+                              align_corners=False, antialias=True)
+        # T.CenterCrop と同じオフセット
+        top  = int(round((new_h - size) / 2.0))
+        left = int(round((new_w - size) / 2.0))
+        out = self._buffer(size, n)
+        torch.sub(x[:, :, top:top+size, left:left+size], self.mean, out=out)
+        return out.div_(self.std)
+
+    def __call__(self, imgs, prepared=False):
+        """ return: {input_size: 正規化済みテンソル} """
+        x = self.to_float(imgs, prepared)
+        return {size: self.resize_normalize(x, size) for size in self.input_sizes}
+
+def predict_frames(detectors, imgs, preprocessor=None, prepared=False):
+    """
+    BGR フレームのバッチを一度だけ前処理し、全検出器の確率を返す。
+    return: (N, len(detectors)) numpy 配列
+    """
+    if preprocessor is None:
+        preprocessor = SharedPreprocessor([det.input_size for det in detectors])
+    inputs = preprocessor(imgs, prepared)
+    return np.stack([det.predict_batch(inputs[det.input_size]) for det in detectors], axis=1)
+
+def preprocess_parity(detector, imgs):
+    """
+    SharedPreprocessor と従来の PIL 前処理 (detector.transform) の入力差を確認する。
+    return: 最大絶対誤差
+    """
+    from PIL import Image
+
+    pre = SharedPreprocessor([detector.input_size], device=torch.device("cpu"))
+    fast = pre(imgs)[detector.input_size]
+    ref = torch.stack([
+        detector.transform(Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)))
+        for img in imgs
+    ])
+    return float((fast - ref).abs().max())
+
+#――――――――――――――――――――――――――
+# int8 量子化（CPU 推論用、オプトイン）
+#――――――――――――――――――――――――――
+def default_quant_mode(detector):
+    """ パラメータの大半が Linear なら動的量子化（ViT）、そうでなければ静的量子化（Xception） """
+    linear = sum(m.weight.numel() for m in detector.model.modules() if isinstance(m, torch.nn.Linear))
+    total  = sum(p.numel() for p in detector.model.parameters())
+    return "dynamic" if linear * 2 >= total else "static"
+
+def calibration_frames(paths, n_calib=64):
+    """
+    静的量子化の較正に使うフレームを paths から等間隔に n_calib 枚選ぶ。
+    paths は評価対象によらない固定のセット（実写フレームや専用の較正セット）にすること。
+    生成動画のフレームを混ぜると int8 モデルが候補ごとに変わり、スコアを比較できなくなる。
+    """
+    idx = np.linspace(0, len(paths) - 1, min(n_calib, len(paths))).astype(int)
+    return [paths[i] for i in idx]
+
+def calib_hash(blobs):
+    """ 較正フレームのファイル内容（順序込み）のハッシュ """
+    h = hashlib.blake2b(digest_size=16)
+    for b in blobs:
+        h.update(hashlib.blake2b(b, digest_size=16).hexdigest().encode())
+    return h.hexdigest()
+
+def quantize_detector(detector, calib_batches=None, mode=None, calib_id=None):
+    """
+    検出器を CPU 上で int8 に量子化する（detector.model を置き換える）。
+      - "dynamic": Linear 層の重みを int8、活性は実行時に量子化
+      - "static" : FX グラフモードで畳み込みを含めて量子化。calib_batches
+                   （SharedPreprocessor の出力テンソルの list）で活性範囲を較正する
+    mode を省略すると default_quant_mode で選ぶ。
+    static では較正セットのハッシュ calib_id（calib_hash）を detector.calib_hash に記録する。
+    """
+    from torch.ao.quantization import quantize_dynamic
+
+    mode = mode or default_quant_mode(detector)
+    model = detector.model.to("cpu").eval()
+    if mode == "static":
+        if not calib_batches:
+            raise ValueError("Static quantization needs calibration batches")
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        calib_batches = [x.to("cpu") for x in calib_batches]
+        prepared = prepare_fx(model, get_default_qconfig_mapping("x86"), (calib_batches[0],))
+        with torch.no_grad():
+            for x in calib_batches:
+                prepared(x)
+        model = convert_fx(prepared)
+    elif mode == "dynamic":
+        model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    else:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+
+    detector.model = model.eval()
+    detector.device = torch.device("cpu")
+    detector.quantized = mode
+    detector.calib_hash = calib_id if mode == "static" else None
+    detector.runner = None
+    return detector
+
 #――――――――――――――――――――――――――
 # 各種検出器クラス
 #――――――――――――――――――――――――――
 class XceptionPP(BaseDetector):
-    def __init__(self, pretrained: bool = True, weight_path: str = None):
+    def __init__(self, pretrained: bool = True, weight_path: str = None, model=None):
         super().__init__(
             model_name='xception',
             input_size=299,
             num_classes=1,
             pretrained=pretrained,
-            weight_path=weight_path
+            weight_path=weight_path,
+            model=model
         )
 
 class ViTDetector(BaseDetector):
-    def __init__(self, pretrained: bool = True, weight_path: str = None):
+    def __init__(self, pretrained: bool = True, weight_path: str = None, model=None):
         super().__init__(
             model_name='vit_base_patch16_224',
             input_size=224,
             num_classes=1,
             pretrained=pretrained,
-            weight_path=weight_path
+            weight_path=weight_path,
+            model=model
         )
 
 #――――――――――――――――――――――――――
 # モジュールエクスポート指定
 #――――――――――――――――――――――――――
 __all__ = [
-    'XceptionPP', 'ViTDetector',
+    'BaseDetector', 'XceptionPP', 'ViTDetector', 'create_backbone',
+    'SharedPreprocessor', 'predict_frames', 'preprocess_parity',
+    'quantize_detector', 'default_quant_mode',
     'MEAN', 'STD', 'DEVICE'
 ]
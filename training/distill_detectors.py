@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# distill_detectors.py
+"""
+XceptionPP + ViTDetector のアンサンブル（P(real) の平均）を、低解像度の小型 timm
+バックボーン1つに蒸留する。学習した生徒モデルは detectors_fast.json として保存し、
+compute_dscore.py --fast でそのまま使える（夜間の回帰スクリーニング用）。
+
+  1. frames/aligned/{gen,real} のフレームを training/frame_cache.py のキャッシュから読む（デコードは初回のみ）
+  2. 教師アンサンブルの平均 P(real) を全フレームについて一度だけ計算（ソフトターゲット）
+  3. 生徒を BCE(ソフトターゲット) で学習
+  4. held-out フレームで生徒と教師の一致度・スループットを表示
+
+Usage:
+    python training/distill_detectors.py --teacher detectors.json --out detectors_fast.json
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn, optim
+from tqdm import tqdm
+
+from detectors import BaseDetector, SharedPreprocessor, predict_frames, DEVICE
+from detector_registry import load_registry, save_registry
+from frame_cache import build_frame_cache, FrameCacheDataset, make_loader, CACHE_ENV
+
+
+def predict_all(detectors, frames, batch_size, indices=None):
+    """
+    frames: RGB uint8 (N, H, W, 3)（キャッシュの memmap 可）。indices を渡すとその行だけ評価する。
+    return: (アンサンブル平均確率, frames/s)
+    """
+    indices = np.arange(len(frames)) if indices is None else indices
+    pre = SharedPreprocessor([det.input_size for det in detectors])
+    probs = []
+    t0 = time.perf_counter()
+    for start in range(0, len(indices), batch_size):
+        batch = frames[indices[start:start+batch_size]]
+        probs.append(predict_frames(detectors, batch, pre, prepared=True).mean(axis=1))
+    return np.concatenate(probs), len(indices) / (time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Distil the detector ensemble into one small student")
+    ap.add_argument("--teacher", default="detectors.json", help="Teacher detector registry")
+    ap.add_argument("--root", default="frames/aligned", help="ImageFolder-style root (real/, gen/)")
+    ap.add_argument("--cache-dir", default=None, help=f"Frame cache (default: ${CACHE_ENV} or ~/.cache)")
+    ap.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="DataLoader workers")
+    ap.add_argument("--out", default="detectors_fast.json", help="Output registry for the student")
+    ap.add_argument("--arch", default="mobilenetv3_small_100", help="timm backbone for the student")
+    ap.add_argument("--input-size", type=int, default=128, help="Student input resolution")
+    ap.add_argument("--scratch", action="store_true",
+                    help="Initialise the student randomly instead of downloading ImageNet weights")
+    ap.add_argument("--epochs", type=int, default=10)
+    ap.add_argument("--batch-size", type=int, default=64)
+    ap.add_argument("--lr", type=float, default=1e-3)
+    ap.add_argument("--holdout-every", type=int, default=5, help="Hold out every k-th frame")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    dataset = FrameCacheDataset(build_frame_cache(args.root, args.cache_dir))
+    frames, labels, classes = dataset.frames, dataset.labels, dataset.classes
+    print(f"[Distill] Loaded {len(frames)} frames {classes} in {time.perf_counter()-t0:.1f}s")
+
+    teachers = load_registry(args.teacher)
+    targets, teacher_fps = predict_all(teachers, frames, args.batch_size)
+    print(f"[Distill] Teacher targets ready ({teacher_fps:.1f} frames/s)")
+    del teachers
+
+    held = np.arange(len(frames)) % args.holdout_every == 0
+    train_idx = np.nonzero(~held)[0]
+
+    student = BaseDetector(args.arch, args.input_size, num_classes=1, pretrained=not args.scratch)
+    model = student.model
+    pre = SharedPreprocessor([args.input_size])
+    criterion = nn.BCEWithLogitsLoss()
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    target_t = torch.from_numpy(targets.astype(np.float32))
+    loader, sampler = make_loader(dataset, args.batch_size, indices=train_idx, seed=0, workers=args.workers)
+
+    for epoch in range(1, args.epochs + 1):
+        model.train()
+        sampler.set_epoch(epoch)
+        running_loss = 0.0
+        progress_bar = tqdm(loader, desc=f"[Student] Epoch {epoch}/{args.epochs}", unit="batch")
+        for batch, _, idx in progress_bar:
+            x = pre(batch.numpy(), prepared=True)[args.input_size]
+            y = target_t[idx].unsqueeze(1).to(DEVICE)
+
+            optimizer.zero_grad()
+            loss = criterion(model(x), y)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item() * len(idx)
+            progress_bar.set_postfix({"loss": f"{loss.item():.4f}"})
+        print(f"[Student] Epoch {epoch}/{args.epochs} completed. Avg loss: {running_loss/len(train_idx):.4f}")
+    model.eval()
+
+    # held-out での生徒/教師の一致度
+    p_student, student_fps = predict_all([student], frames, args.batch_size, np.nonzero(held)[0])
+    p_teacher = targets[held]
+    agree = np.mean((p_student >= 0.5) == (p_teacher >= 0.5))
+    corr = np.corrcoef(p_student, p_teacher)[0, 1] if len(p_student) > 1 else float('nan')
+    print(f"\n[Distill] held-out frames: {int(held.sum())}")
+    print(f"[Distill] MAE |p_student - p_teacher| = {np.mean(np.abs(p_student - p_teacher)):.4f}")
+    print(f"[Distill] Pearson r = {corr:.4f}  decision agreement = {agree*100:.2f}%")
+    for label, cls in enumerate(classes):
+        m = labels[held] == label
+        if m.any():
+            print(f"[Distill] {cls:5s} mean P(real)  teacher={p_teacher[m].mean():.4f}  student={p_student[m].mean():.4f}")
+    print(f"[Distill] Throughput  teacher={teacher_fps:.1f}  student={student_fps:.1f} frames/s "
+          f"({student_fps/teacher_fps:.1f}x)")
+
+    student.name = "DistilledStudent"
+    save_registry([student], args.out)
+    print(f"生徒モデルを {args.out} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
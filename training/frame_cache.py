@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# frame_cache.py
+"""
+検出器学習用のデコード済みフレームキャッシュ。
+
+frames/aligned/{gen,real} の画像を一度だけデコードし、
+  - frames.npy : RGB uint8 の配列 (N, H, W, 3)（np.load(mmap_mode='r') で読む）
+  - labels.npy : ImageFolder と同じクラス番号（クラス名順）
+  - meta.json  : クラス名・ファイル一覧
+としてキャッシュに保存する。キャッシュのキーはファイル名・サイズ・更新時刻のハッシュなので、
+フレームが変わらない限りエポックごと・実行ごとの PNG デコードは発生しない。
+
+FrameCacheDataset はインデックスのバッチ単位で memmap からスライスを返すだけなので、
+DataLoader のワーカー（persistent_workers）はほぼ I/O のみ。リサイズ・正規化は
+消費側で SharedPreprocessor（バッチ単位の torch 演算）が行う。
+シャッフル順は seed とエポック番号だけで決まる（ワーカー数に依存しない）。
+
+Usage（キャッシュの事前作成）:
+    python training/frame_cache.py --root frames/aligned
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+CACHE_ENV = "TRAIN_FRAME_CACHE"
+CACHE_VERSION = 1
+IMG_EXTS = ('.png', '.jpg', '.jpeg')
+
+
+def default_cache_dir():
+    return os.environ.get(
+        CACHE_ENV,
+        os.path.join(os.path.expanduser("~"), ".cache", "evaluate_maked_video", "frames"),
+    )
+
+
+def list_image_folder(root):
+    """ ImageFolder と同じ並び（クラス名順 → ファイル名順）で (パス, ラベル) と クラス名 を返す """
+    classes = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    items = []
+    for label, cls in enumerate(classes):
+        files = sorted(f for f in os.listdir(os.path.join(root, cls)) if f.lower().endswith(IMG_EXTS))
+        items.extend((os.path.join(root, cls, f), label) for f in files)
+    return items, classes
+
+
+def fingerprint(items):
+    """ ファイル名・サイズ・更新時刻からキャッシュのキーを作る（内容は読まない） """
+    h = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    for path, label in items:
+        st = os.stat(path)
+        h.update(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{label}\n".encode())
+    return h.hexdigest()[:16]
+
+
+def _read_rgb(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError(f"Cannot read image: {path}")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def build_frame_cache(root, cache_dir=None, workers=8):
+    """
+    root 以下のフレームをデコードしてキャッシュに書き出す（既にあれば何もしない）。
+    return: キャッシュのディレクトリ
+    """
+    items, classes = list_image_folder(root)
+    if not items:
+        raise ValueError(f"No images found under {root}")
+    cache_dir = cache_dir or default_cache_dir()
+    out_dir = os.path.join(cache_dir, fingerprint(items))
+    if os.path.exists(os.path.join(out_dir, "meta.json")):
+        return out_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    first = _read_rgb(items[0][0])
+    # 一時ディレクトリに書いてから rename（途中で落ちても壊れたキャッシュを残さない）
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        frames = np.lib.format.open_memmap(os.path.join(tmp_dir, "frames.npy"), mode="w+",
+                                           dtype=np.uint8, shape=(len(items),) + first.shape)
+
+        def decode(i):
+            img = _read_rgb(items[i][0])
+            if img.shape != first.shape:
+                raise ValueError(f"{items[i][0]} is {img.shape}, expected {first.shape} (frames must be aligned)")
+            frames[i] = img
+
+        # cv2 のデコードは GIL を解放するのでスレッドで並列化できる
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(decode, range(len(items))))
+        frames.flush()
+        del frames
+        np.save(os.path.join(tmp_dir, "labels.npy"), np.array([label for _, label in items], dtype=np.int64))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"version": CACHE_VERSION, "root": os.path.abspath(root), "classes": classes,
+                       "files": [os.path.relpath(p, root) for p, _ in items]}, f, indent=2)
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        # 並列に同じキャッシュを作った場合は先に完成した方を使う
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(out_dir, "meta.json")):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    print(f"[FrameCache] Decoded {len(items)} frames {classes} -> {out_dir} in {time.perf_counter()-t0:.1f}s")
+    return out_dir
+
+
+class FrameCacheDataset(Dataset):
+    """
+    インデックスのバッチ → (RGB uint8 テンソル (B, H, W, 3), ラベル (B,), インデックス (B,))。
+    memmap はワーカーごとに初回アクセス時に開く（配列をワーカーへ pickle しない）。
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.labels = np.load(os.path.join(cache_path, "labels.npy"))
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            self.classes = json.load(f)["classes"]
+        self._frames = None
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = np.load(os.path.join(self.cache_path, "frames.npy"), mmap_mode="r")
+        return self._frames
+
+    def __getstate__(self):
+        return {**self.__dict__, "_frames": None}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        idx = np.sort(np.asarray(idx))   # memmap を前から順に読む
+        return (torch.from_numpy(np.ascontiguousarray(self.frames[idx])),
+                torch.from_numpy(self.labels[idx]),
+                torch.from_numpy(idx))
+
+
+class EpochBatchSampler(Sampler):
+    """ seed とエポック番号から決まる順列でインデックスのバッチを返す（set_epoch で切り替え） """
+    def __init__(self, indices, batch_size, seed=0, shuffle=True):
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = self.indices
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(order)
+        for start in range(0, len(order), self.batch_size):
+            yield order[start:start+self.batch_size]
+
+
+def make_loader(dataset, batch_size, indices=None, seed=0, shuffle=True, workers=4):
+    """
+    dataset（FrameCacheDataset）のバッチ単位の DataLoader。
+    return: (loader, sampler)  エポックごとに sampler.set_epoch(epoch) を呼ぶ
+    """
+    indices = np.arange(len(dataset)) if indices is None else indices
+    sampler = EpochBatchSampler(indices, batch_size, seed, shuffle)
+    extra = {"persistent_workers": True, "prefetch_factor": 4} if workers > 0 else {}
+    loader = DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=workers,
+                        pin_memory=torch.cuda.is_available(), **extra)
+    return loader, sampler
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Decode aligned frames once into the training frame cache")
+    ap.add_argument("--root", default="frames/aligned", help="ImageFolder-style root (real/, gen/)")
+    ap.add_argument("--cache-dir", default=None, help=f"Frame cache (default: ${CACHE_ENV} or ~/.cache)")
+    ap.add_argument("--workers", type=int, default=8, help="Decode threads")
+    args = ap.parse_args()
+
+    path = build_frame_cache(args.root, args.cache_dir, args.workers)
+    dataset = FrameCacheDataset(path)
+    print(f"[FrameCache] {path}: {len(dataset)} frames {tuple(dataset.frames.shape[1:])} {dataset.classes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,12 @@
 # generate_detectors.py
-import pickle
 from detectors import XceptionPP, ViTDetector
+from detector_registry import save_registry, REGISTRY_PATH
 
 def main():
     det1 = XceptionPP()
     det2 = ViTDetector()
-    with open('detectors.pkl', 'wb') as f:
-        pickle.dump([det1, det2], f)
-    print("detectors.pkl を作成しました。")
+    save_registry([det1, det2], REGISTRY_PATH)
+    print(f"{REGISTRY_PATH} を作成しました。")
 
 if __name__ == '__main__':
     main()
@@ -11,114 +11,228 @@ Usage:
       --out_features X_train.npy \
       --out_labels   y_train.npy
 
+--real_dir / --gen_dir には複数のパスを指定できる。各パスは
+  - 動画ファイル（.mp4/.avi/.mov）
+  - 動画ファイルを含むディレクトリ（動画ごとに1サンプル）
+  - アライン済みフレーム（*.png）のディレクトリ（ディレクトリ全体で1サンプル）
+のいずれか。
+--segment-sec を指定すると、各サンプルを segment-sec 秒ずつの区間（重なりなし）に分けて
+区間ごとに1行を出力する（frames/aligned/real のように1ディレクトリしかない場合でも複数行になる）。
+
 出力:
-    X_train.npy  : 特徴量配列 (N_samples, N_features)
-    y_train.npy  : ラベル配列  (N_samples,)  1:実写／0:生成
+    X_train.npy           : 特徴量配列 (N_samples, N_features)  ※ np.load(mmap_mode='r') で読める
+    y_train.npy           : ラベル配列  (N_samples,)  1:実写／0:生成
+    X_train.manifest.json : 各行がどのサンプル（パス・sha256・ラベル・区間の先頭フレーム）から作られたか
 
-特徴量:
+特徴量（training/rppg_features.py のエンジンを compute_rppg.py と共通で使用）:
   - 顔ROIを grid_size×grid_size のパッチに分割
   - 各パッチの緑チャンネル平均をフレームごとに抽出
   - Butterworth bandpass フィルタ (0.7–4Hz) を通した信号
   - パッチ間相互相関係数 (上三角) を特徴量ベクトル化
 
+--landmarks を指定すると、グリッドの代わりにランドマークから作った額・頬の ROI マスクで信号を取る
+（全サンプルに extract_landmarks.py の .npy が必要。compute_rppg.py --landmarks と対で使う）。
+
+サンプルごとの特徴量は「ファイル内容の sha256 + 抽出パラメータ」をキーにキャッシュするので、
+動画を追加して作り直すときは新しい動画の分だけ計算すればよい。抽出はプロセスプールで並列に行う。
 """
 import os
 import argparse
+import glob
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import cv2
-from scipy.signal import butter, filtfilt
-
-
-def bandpass_filter(signal, fs=30, low=0.7, high=4.0, order=4):
-    nyq = 0.5 * fs
-    b, a = butter(order, [low/nyq, high/nyq], btype='band')
-    return filtfilt(b, a, signal)
-
-
-def extract_rppg_features(video_path, patch_size=64, grid_size=4, fs=30):
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise FileNotFoundError(f"Cannot open video: {video_path}")
-    frames = []
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frames.append(frame)
-    cap.release()
-    if len(frames) == 0:
-        raise ValueError(f"No frames in video: {video_path}")
-
-    h, w, _ = frames[0].shape
-    # パッチのステップ
-    step_y = max((h - patch_size) // (grid_size - 1), 1)
-    step_x = max((w - patch_size) // (grid_size - 1), 1)
-
-    # 各パッチの時系列信号収集
-    patch_signals = [[] for _ in range(grid_size * grid_size)]
-    for img in frames:
-        for i in range(grid_size):
-            for j in range(grid_size):
-                y = i * step_y
-                x = j * step_x
-                patch = img[y:y+patch_size, x:x+patch_size]
-                # BGR -> 緑チャンネル平均
-                green_mean = cv2.cvtColor(patch, cv2.COLOR_BGR2RGB)[:, :, 1].mean()
-                patch_signals[i*grid_size + j].append(green_mean)
-
-    # バンドパスフィルタ
-    filtered = []
-    for sig in patch_signals:
-        sig_arr = np.array(sig)
-        f = bandpass_filter(sig_arr, fs=fs)
-        filtered.append(f)
-
-    # パッチ間相互相関 (上三角)
-    feats = []
-    P = grid_size * grid_size
-    for i in range(P):
-        for j in range(i+1, P):
-            # 相関係数
-            c = np.corrcoef(filtered[i], filtered[j])[0, 1]
-            feats.append(c)
-    return np.array(feats)
+
+from rppg_features import extract_features, extract_segment_features, open_source, RoiSampler, FEATURE_VERSION
+
+VIDEO_EXTS = ('.mp4', '.avi', '.mov')
+CACHE_ENV = "RPPG_FEATURE_CACHE"
+
+
+def default_cache_dir():
+    return os.environ.get(
+        CACHE_ENV,
+        os.path.join(os.path.expanduser("~"), ".cache", "evaluate_maked_video", "rppg"),
+    )
+
+
+def extract_rppg_features(video_path, patch_size=64, grid_size=4, fs=30, landmarks=None):
+    """
+    動画（またはフレームディレクトリ）をストリーミングで読み、compute_rppg.py と同じエンジンで特徴量を計算。
+    landmarks を渡すとグリッドの代わりに額・頬の ROI マスクを使う。
+    """
+    sampler = RoiSampler(landmarks) if landmarks else None
+    return extract_features(open_source(video_path), patch_size=patch_size, grid_size=grid_size, fs=fs,
+                            sampler=sampler)
+
+
+def extract_rppg_segments(video_path, segment, patch_size=64, grid_size=4, fs=30, landmarks=None):
+    """ extract_rppg_features を segment フレームずつの区間ごとに計算する → (区間数, 特徴次元) """
+    sampler = RoiSampler(landmarks) if landmarks else None
+    feats, _ = extract_segment_features(open_source(video_path), segment, patch_size=patch_size,
+                                        grid_size=grid_size, fs=fs, sampler=sampler)
+    return feats
+
+
+def list_samples(paths):
+    """ 指定パスをサンプル（動画ファイル または フレームディレクトリ）の list に展開する """
+    samples = []
+    for path in paths:
+        if os.path.isdir(path):
+            videos = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(VIDEO_EXTS))
+            if videos:
+                samples.extend(videos)
+            elif glob.glob(os.path.join(path, "*.png")):
+                samples.append(path)
+            else:
+                print(f"[WARN] No videos or frames found in {path}")
+        else:
+            samples.append(path)
+    return samples
+
+
+def sample_sha256(path, chunk_size=1 << 20):
+    """ 動画はファイル内容、フレームディレクトリはファイル名と内容を順に連結した sha256 """
+    h = hashlib.sha256()
+    files = sorted(glob.glob(os.path.join(path, "*.png"))) if os.path.isdir(path) else [path]
+    for fn in files:
+        if len(files) > 1:
+            h.update(os.path.basename(fn).encode())
+        with open(fn, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(digest, patch_size, grid_size, fs, landmarks_digest=None, segment=0):
+    seg = f"_seg{segment}" if segment else ""
+    if landmarks_digest:
+        return f"{digest}_v{FEATURE_VERSION}_roi{landmarks_digest[:16]}_fs{fs}{seg}"
+    return f"{digest}_v{FEATURE_VERSION}_p{patch_size}_g{grid_size}_fs{fs}{seg}"
+
+
+def parse_landmarks(pairs):
+    """ 'サンプルのパス=ランドマーク.npy' の list を dict にする """
+    mapping = {}
+    for pair in pairs or []:
+        sample, sep, path = pair.partition("=")
+        if not sep:
+            raise SystemExit(f"[ERROR] --landmarks expects SAMPLE=LANDMARKS.npy, got {pair}")
+        mapping[os.path.normpath(sample)] = path
+    return mapping
+
+
+def _build_one(task):
+    """
+    ワーカープロセスで1サンプルを処理する（キャッシュがあれば読むだけ）。
+    segment > 0 なら区間ごとの特徴量 (区間数, 特徴次元)、0 ならサンプル全体の特徴量 (特徴次元,)。
+    return: (sha256, 特徴量 or None, キャッシュヒットか, エラーメッセージ or None)
+    """
+    path, cache_dir, patch_size, grid_size, fs, landmarks, segment = task
+    try:
+        digest = sample_sha256(path)
+        lm_digest = sample_sha256(landmarks) if landmarks else None
+        cache_path = os.path.join(cache_dir,
+                                  cache_key(digest, patch_size, grid_size, fs, lm_digest, segment) + ".npy")
+        if os.path.exists(cache_path):
+            return digest, np.load(cache_path), True, None
+        if segment:
+            feats = extract_rppg_segments(path, segment, patch_size=patch_size, grid_size=grid_size, fs=fs,
+                                          landmarks=landmarks)
+        else:
+            feats = extract_rppg_features(path, patch_size=patch_size, grid_size=grid_size, fs=fs,
+                                          landmarks=landmarks)
+        # 一時ファイルに書いてから rename（並列実行や中断で壊れたキャッシュを残さない）
+        tmp = f"{cache_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp, feats)
+        os.replace(tmp, cache_path)
+        return digest, feats, False, None
+    except Exception as e:
+        return None, None, False, f"{type(e).__name__}: {e}"
 
 
 def main(args):
-    real_files = sorted([os.path.join(args.real_dir, f) for f in os.listdir(args.real_dir)
-                         if f.lower().endswith(('.mp4', '.avi', '.mov'))])
-    gen_files  = sorted([os.path.join(args.gen_dir,  f) for f in os.listdir(args.gen_dir)
-                         if f.lower().endswith(('.mp4', '.avi', '.mov'))])
-
-    X, y = [], []
-    print("[INFO] Extracting real video features...")
-    for v in real_files:
-        feats = extract_rppg_features(v, patch_size=args.patch_size,
-                                      grid_size=args.grid_size, fs=args.fps)
-        X.append(feats)
-        y.append(1)
-    print("[INFO] Extracting generated video features...")
-    for v in gen_files:
-        feats = extract_rppg_features(v, patch_size=args.patch_size,
-                                      grid_size=args.grid_size, fs=args.fps)
-        X.append(feats)
-        y.append(0)
+    cache_dir = args.cache_dir or default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    samples = [(p, 1) for p in list_samples(args.real_dir)] + [(p, 0) for p in list_samples(args.gen_dir)]
+    print(f"[INFO] {len(samples)} samples  workers={args.workers}  cache={cache_dir}")
+
+    t0 = time.perf_counter()
+    landmarks = parse_landmarks(args.landmarks)
+    if landmarks:
+        # ROI モードでは全サンプルにランドマークが必要（グリッドとは特徴量の次元が違う）
+        missing = [p for p, _ in samples if os.path.normpath(p) not in landmarks]
+        if missing:
+            raise SystemExit(f"[ERROR] No --landmarks entry for: {', '.join(missing)}")
+    segment = round(args.segment_sec * args.fps) if args.segment_sec else 0
+    tasks = [(p, cache_dir, args.patch_size, args.grid_size, args.fps, landmarks.get(os.path.normpath(p)), segment)
+             for p, _ in samples]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(_build_one, tasks, chunksize=1))
+
+    X, y, rows, skipped = [], [], [], []
+    hits = 0
+    for (path, label), (digest, feats, cached, error) in zip(samples, results):
+        if error is not None:
+            print(f"[WARN] Skipped {path}: {error}")
+            skipped.append({"path": path, "label": label, "error": error})
+            continue
+        hits += cached
+        if not segment:
+            rows.append({"row": len(X), "path": path, "label": label, "sha256": digest})
+            X.append(feats)
+            y.append(label)
+            continue
+        # 区間ごとに1行（区間 k はフレーム k*segment から segment フレーム）
+        for k, row in enumerate(feats):
+            rows.append({"row": len(X), "path": path, "label": label, "sha256": digest,
+                         "start_frame": k * segment})
+            X.append(row)
+            y.append(label)
+    if not X:
+        raise SystemExit("[ERROR] No features were extracted")
+    n_done = len(samples) - len(skipped)
+    print(f"[INFO] Extracted {n_done - hits} new, {hits} from cache, {len(skipped)} skipped "
+          f"in {time.perf_counter()-t0:.1f}s ({len(X)} rows)")
 
     X = np.stack(X)
     y = np.array(y)
     print(f"[INFO] Features shape: {X.shape}, Labels shape: {y.shape}")
 
+    for path in (args.out_features, args.out_labels):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
     np.save(args.out_features, X)
     np.save(args.out_labels,   y)
-    print(f"[INFO] Saved X-> {args.out_features}, y-> {args.out_labels}")
+    manifest_path = args.manifest or os.path.splitext(args.out_features)[0] + ".manifest.json"
+    with open(manifest_path, "w") as f:
+        json.dump({
+            "features": args.out_features,
+            "labels": args.out_labels,
+            "params": {"patch_size": args.patch_size, "grid_size": args.grid_size, "fps": args.fps,
+                       "roi": bool(landmarks), "feature_version": FEATURE_VERSION,
+                       "segment_sec": args.segment_sec},
+            "rows": rows,
+            "skipped": skipped,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"[INFO] Saved X-> {args.out_features}, y-> {args.out_labels}, manifest-> {manifest_path}")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--real_dir',    required=True, help='実写動画ディレクトリ')
-    parser.add_argument('--gen_dir',     required=True, help='生成動画ディレクトリ')
+    parser.add_argument('--real_dir',    required=True, nargs='+', help='実写動画（ディレクトリ・動画・フレームディレクトリ）')
+    parser.add_argument('--gen_dir',     required=True, nargs='+', help='生成動画（ディレクトリ・動画・フレームディレクトリ）')
     parser.add_argument('--out_features', required=True, help='出力X_train.npy')
     parser.add_argument('--out_labels',   required=True, help='出力y_train.npy')
+    parser.add_argument('--manifest',    default=None, help='行ごとの出典（デフォルト: <out_features>.manifest.json）')
+    parser.add_argument('--cache-dir',   default=None, help=f'特徴量キャッシュ（デフォルト: ${CACHE_ENV} または ~/.cache）')
+    parser.add_argument('--landmarks',   nargs='+', default=None, metavar='SAMPLE=NPY',
+                        help='額・頬の ROI モード: サンプルごとのランドマーク（例: frames/aligned/real=landmarks/real.npy）')
+    parser.add_argument('--segment-sec', type=float, default=None,
+                        help='各サンプルをこの秒数の区間に分けて区間ごとに1行を出力（デフォルト: サンプル全体で1行）')
+    parser.add_argument('--workers',     type=int, default=os.cpu_count(), help='並列プロセス数')
     parser.add_argument('--patch_size',  type=int, default=64)
     parser.add_argument('--grid_size',   type=int, default=4)
     parser.add_argument('--fps',         type=int, default=30)
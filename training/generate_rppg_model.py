@@ -8,27 +8,48 @@ rPPG Realness Score用ロジスティック回帰モデルを学習・保存す
 - 特徴量データ: X_train.npy (shape=(N_samples, N_features))
 - ラベルデータ:   y_train.npy (shape=(N_samples,)), 1:実写、0:生成
 
+モデルは pickle ではなく rppg_model.json（係数・切片・特徴量の設定, training/rppg_model.py）に保存する。
+特徴量の設定（patch_size / grid_size / fps / roi）は generate_rppg_features.py の manifest から取る。
+
 Usage:
     python generate_rppg_model.py --features X_train.npy --labels y_train.npy
 """
 
 import argparse
+import json
+import os
 import numpy as np
-import pickle
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 
+from rppg_model import RppgModel, save_model, MODEL_PATH
+
+# 検証データを分けるのに必要なクラスごとの最小サンプル数
+MIN_VAL_SAMPLES = 5
+
 
 def main(args):
     # 特徴量とラベルの読み込み
     X = np.load(args.features)
     y = np.load(args.labels)
 
-    # 学習 / 検証データ分割
-    X_tr, X_val, y_tr, y_val = train_test_split(
-        X, y, test_size=0.2, random_state=42
-    )
+    # クラスごとのサンプル数（1ディレクトリ = 1サンプルだと各クラス1行しかない）
+    classes, counts = np.unique(y, return_counts=True)
+    per_class = {int(c): int(n) for c, n in zip(classes, counts)}
+    if len(classes) < 2 or counts.min() < 2:
+        raise SystemExit(f"[ERROR] Need at least 2 samples of each class (1:real, 0:generated), got {per_class}. "
+                         "Pass more videos or split them with generate_rppg_features.py --segment-sec")
+
+    # 学習 / 検証データ分割（少なすぎる場合は分割せず全データで学習する）
+    if counts.min() < MIN_VAL_SAMPLES:
+        print(f"[WARN] Only {per_class} samples per class; skipping the validation split "
+              f"(needs >= {MIN_VAL_SAMPLES} per class)")
+        X_tr, X_val, y_tr, y_val = X, None, y, None
+    else:
+        X_tr, X_val, y_tr, y_val = train_test_split(
+            X, y, test_size=0.2, random_state=42, stratify=y
+        )
 
     # モデル定義
     model = LogisticRegression(max_iter=1000)
@@ -36,19 +57,31 @@ def main(args):
     model.fit(X_tr, y_tr)
 
     # 検証精度確認
-    y_pred = model.predict(X_val)
-    acc = accuracy_score(y_val, y_pred)
-    print(f"Validation Accuracy: {acc*100:.2f}%")
+    if X_val is not None:
+        y_pred = model.predict(X_val)
+        acc = accuracy_score(y_val, y_pred)
+        print(f"Validation Accuracy: {acc*100:.2f}%")
+
+    # 特徴量の設定（評価時に同じ設定で抽出するためモデルと一緒に保存する）
+    manifest = args.manifest or os.path.splitext(args.features)[0] + ".manifest.json"
+    config = None
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            config = json.load(f)["params"]
+    else:
+        print(f"[WARN] {manifest} not found; recording the default feature settings")
 
     # モデル保存
-    with open('rppg_model.pkl', 'wb') as f:
-        pickle.dump(model, f)
-    print("rppg_model.pkl を作成しました。")
+    rppg_model = RppgModel.from_sklearn(model, config)
+    save_model(rppg_model, args.out)
+    print(f"{args.out} を作成しました。(feature config: {rppg_model.config})")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--features', required=True, help='特徴量.npyファイルパス')
     parser.add_argument('--labels', required=True, help='ラベル.npyファイルパス')
+    parser.add_argument('--manifest', default=None, help='特徴量の manifest（デフォルト: <features>.manifest.json）')
+    parser.add_argument('--out', default=MODEL_PATH, help='出力モデル（JSON）')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# quantize_detectors.py
+"""
+int8 量子化した検出器と fp32 の検出器を、アライン済みフレームの評価セットで比較する。
+リリースごとに量子化モードを採用するか判断するためのレポートを出力する。
+
+  - 評価: --eval-root（検出器の学習に使っていないフレーム, real/ gen/）の全フレーム
+          （ラベル real=1 / gen=0）
+  - 較正: --root の real/ のフレーム（または --calib）から等間隔に --calib-frames 枚
+          （compute_dscore.py --quantize と同じ固定の較正セット。gen 側のフレームは使わない）
+
+--eval-root を省略すると --root のフレームを --holdout-every 枚ごとに 1 枚評価に回す。
+frames/aligned は検出器の学習データそのものなので、この場合の精度は held-out ではなく
+学習フレーム上の値になり、int8 による精度低下を過小評価しうる（レポートにもそう表示する）。
+
+Usage:
+    python training/quantize_detectors.py --detectors detectors.json --root frames/aligned --eval-root frames/eval
+"""
+
+import argparse
+import glob
+import io
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from detectors import SharedPreprocessor, quantize_detector, default_quant_mode, calibration_frames, calib_hash
+from detector_registry import load_registry
+
+
+def split_frames(root, holdout_every, calib_class="real"):
+    """
+    ImageFolder と同じくクラス名のソート順でラベル付け（gen=0, real=1）。
+    holdout_every=1 なら全フレームを評価側に、0 なら評価側に回さない。
+    評価に回さなかった calib_class のフレームが較正の候補になる（他のクラスは較正に使わない）。
+    """
+    calib, held, labels = [], [], []
+    classes = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    for label, cls in enumerate(classes):
+        paths = sorted(glob.glob(os.path.join(root, cls, "*.png")))
+        for i, p in enumerate(paths):
+            if holdout_every and i % holdout_every == 0:
+                held.append(p)
+                labels.append(label)
+            elif cls == calib_class:
+                calib.append(p)
+    return calib, held, np.asarray(labels), classes
+
+
+def model_size_mb(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2**20
+
+
+def score(det, preprocessor, paths, batch_size):
+    """ return: (確率 (N,), 1フレームあたりの推論秒) """
+    probs, infer_s = [], 0.0
+    for start in range(0, len(paths), batch_size):
+        imgs = [cv2.imread(p) for p in paths[start:start+batch_size]]
+        x = preprocessor(imgs)[det.input_size]
+        t0 = time.perf_counter()
+        probs.append(det.predict_batch(x))
+        infer_s += time.perf_counter() - t0
+    return np.concatenate(probs), infer_s / max(1, len(paths))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Accuracy/latency report for int8 quantized detectors")
+    ap.add_argument("--detectors", default="detectors.json", help="Detector registry")
+    ap.add_argument("--root", default="frames/aligned", help="ImageFolder-style root (real/, gen/)")
+    ap.add_argument("--eval-root", default=None,
+                    help="ImageFolder-style root of frames NOT used to train the detectors (real/, gen/)")
+    ap.add_argument("--holdout-every", type=int, default=5,
+                    help="Without --eval-root, evaluate on every k-th frame of --root (training frames)")
+    ap.add_argument("--calib-frames", type=int, default=64, help="Frames used for static calibration")
+    ap.add_argument("--calib", default=None,
+                    help="Glob for the fixed calibration set (default: the real/ frames of --root)")
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--mode", choices=["dynamic", "static"], default=None,
+                    help="Force a quantization mode (default: dynamic for ViT-like, static for CNNs)")
+    args = ap.parse_args()
+
+    if args.eval_root:
+        calib_paths, _, _, _ = split_frames(args.root, 0)
+        _, held_paths, labels, classes = split_frames(args.eval_root, 1)
+        eval_name = "held-out"
+    else:
+        calib_paths, held_paths, labels, classes = split_frames(args.root, args.holdout_every)
+        eval_name = "training-frame"
+    if args.calib:
+        calib_paths = sorted(glob.glob(args.calib))
+    if len(held_paths) == 0:
+        print(f"[Quant] No evaluation frames found under {args.eval_root or args.root}")
+        return
+    real_label = classes.index("real") if "real" in classes else 1
+    print(f"[Quant] {eval_name} eval={len(held_paths)} frames  calibration pool={len(calib_paths)} frames")
+    if not args.eval_root:
+        print("[Quant] WARNING: evaluating on frames the detectors were trained on (not held out); "
+              "pass --eval-root for a held-out accuracy")
+
+    fp32 = load_registry(args.detectors)
+    int8 = load_registry(args.detectors)
+    calib_paths = calibration_frames(calib_paths, args.calib_frames) if calib_paths else []
+    calib_blobs = []
+    for p in calib_paths:
+        with open(p, "rb") as f:
+            calib_blobs.append(f.read())
+    calib_id = calib_hash(calib_blobs)
+
+    for det32, det8 in zip(fp32, int8):
+        pre = SharedPreprocessor([det32.input_size], device=torch.device("cpu"))
+        mode = args.mode or default_quant_mode(det8)
+        calib = None
+        if mode == "static":
+            imgs = [cv2.imdecode(np.frombuffer(b, dtype=np.uint8), cv2.IMREAD_COLOR) for b in calib_blobs]
+            calib = [pre(imgs[i:i+args.batch_size])[det8.input_size].clone()
+                     for i in range(0, len(imgs), args.batch_size)]
+        size32 = model_size_mb(det32.model)
+        t0 = time.perf_counter()
+        quantize_detector(det8, calib, mode, calib_id)
+        quant_s = time.perf_counter() - t0
+
+        # fp32 側も CPU で比較する
+        det32.model.to("cpu")
+        det32.device = torch.device("cpu")
+        p32, lat32 = score(det32, pre, held_paths, args.batch_size)
+        p8,  lat8  = score(det8,  pre, held_paths, args.batch_size)
+        y = (labels == real_label).astype(int)
+        acc32 = float(np.mean((p32 >= 0.5) == y))
+        acc8  = float(np.mean((p8  >= 0.5) == y))
+
+        calib_info = f"  calibration={len(calib_paths)} frames {calib_id[:12]}" if mode == "static" else ""
+        print(f"\n[{det8.name}] mode={mode}  quantize={quant_s:.1f}s{calib_info}")
+        print(f"  {eval_name} accuracy   fp32={acc32*100:.2f}%  int8={acc8*100:.2f}%  Δ={(acc8-acc32)*100:+.2f}pt")
+        print(f"  mean|Δp|={np.mean(np.abs(p8-p32)):.4f}  max|Δp|={np.max(np.abs(p8-p32)):.4f}  "
+              f"decision agreement={np.mean((p8>=0.5)==(p32>=0.5))*100:.2f}%")
+        print(f"  latency    fp32={lat32*1e3:.1f}ms/frame  int8={lat8*1e3:.1f}ms/frame  "
+              f"speedup={lat32/max(lat8, 1e-9):.2f}x")
+        print(f"  size       fp32={size32:.1f}MB  int8={model_size_mb(det8.model):.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# rppg_features.py
+"""
+rPPG Realness Score 用の特徴量エンジン（学習・評価で共通）。
+
+  - 顔ROIを grid_size×grid_size のパッチに分割
+  - 各パッチの緑チャンネル平均をフレームごとに抽出
+    （パッチの行・列を選ぶ 0/1 行列との積で、全フレーム・全パッチの和を一度に求める）
+  - Butterworth bandpass フィルタ (0.7–4Hz) を全パッチ信号へ filtfilt(axis=-1) で一度に適用
+  - パッチ間相関係数行列の上三角を特徴量ベクトルにする（長さ P*(P-1)/2）
+
+入力はフレームソース（動画ファイル / アライン済み PNG ディレクトリ / .npy のフレームストア）で、
+BGR uint8 のフレームを CHUNK_FRAMES 枚ずつ読みながらパッチ信号 (P, N) だけを蓄積する。
+フレーム自体は保持しないので、長いクリップでもメモリは一定（信号は 1 フレームあたり P 個の float）。
+緑は BGR でも RGB でもチャンネル 1 なので、色変換は行わない。
+
+パッチの代わりに、キャッシュ済みの MediaPipe ランドマーク（extract_landmarks.py の .npy）から
+額・左右の頬のポリゴンマスクを作る ROI モード（RoiSampler）もある。
+"""
+
+import glob
+import os
+
+import cv2
+import numpy as np
+from scipy.signal import butter, filtfilt, sosfilt, sosfilt_zi
+
+GREEN = 1
+# 特徴量の定義を変えたら上げる（generate_rppg_features.py のキャッシュキーに含まれる）
+FEATURE_VERSION = 1
+# フレームソースが一度に読み込むフレーム数
+CHUNK_FRAMES = 64
+
+
+def patch_grid(h, w, patch_size=64, grid_size=4):
+    """ パッチ左上の座標 (ys, xs)。従来のループ実装と同じステップで並べる """
+    step_y = max((h - patch_size) // max(grid_size - 1, 1), 1)
+    step_x = max((w - patch_size) // max(grid_size - 1, 1), 1)
+    return np.arange(grid_size) * step_y, np.arange(grid_size) * step_x
+
+
+def patch_selectors(h, w, patch_size=64, grid_size=4):
+    """
+    パッチの行・列の範囲を 0/1 の選択行列にする。
+    return: (rows (G, H), cols (W, G), 各パッチの画素数 (G, G))
+    画像端ではパッチが切り詰められる（スライスと同じ）。
+    """
+    ys, xs = patch_grid(h, w, patch_size, grid_size)
+    y1, x1 = np.minimum(ys + patch_size, h), np.minimum(xs + patch_size, w)
+    rows = ((np.arange(h) >= ys[:, None]) & (np.arange(h) < y1[:, None])).astype(np.float32)
+    cols = ((np.arange(w) >= xs[:, None]) & (np.arange(w) < x1[:, None])).astype(np.float32).T
+    return rows, cols, np.outer(y1 - ys, x1 - xs)
+
+
+# MediaPipe FaceMesh の頂点番号で表した肌の ROI ポリゴン（髪・背景・目を避ける）
+ROI_POLYGONS = {
+    "forehead":    [67, 109, 10, 338, 297, 299, 337, 151, 108, 69],
+    "left_cheek":  [116, 117, 118, 101, 36, 205, 187, 123],
+    "right_cheek": [345, 346, 347, 330, 266, 425, 411, 352],
+}
+
+
+class GridSampler:
+    """ grid_size×grid_size の正方形パッチの平均（パッチ番号は i*grid_size + j） """
+    def __init__(self, patch_size=64, grid_size=4):
+        self.patch_size, self.grid_size = patch_size, grid_size
+        self.n_signals = grid_size * grid_size
+        self._shape = None
+
+    def __call__(self, frames, start):
+        """ frames: (n, H, W, 3) → (P, n)。start は先頭フレームの通し番号（未使用） """
+        if frames.shape[1:3] != self._shape:
+            self._shape = frames.shape[1:3]
+            self._rows, self._cols, self._area = patch_selectors(*self._shape, self.patch_size, self.grid_size)
+        g = np.asarray(frames[..., GREEN], dtype=np.float32)
+        return (self._rows @ g @ self._cols / self._area).reshape(len(g), -1).T
+
+
+def load_landmarks(path):
+    """ extract_landmarks.py の出力（フレームごとの (468, 2) 画素座標 または None）を読む """
+    return list(np.load(path, allow_pickle=True))
+
+
+def roi_segments(landmarks, drift_px=3.0):
+    """
+    フレームはアライン済みなのでランドマークはほぼ動かない。ROI 頂点の平均移動量が drift_px を
+    超えたフレームでだけ区間を切り、区間ごとに中央値のランドマークを使う。
+    return: [(開始フレーム, (468, 2) のランドマーク)]
+    """
+    idx = sorted({i for poly in ROI_POLYGONS.values() for i in poly})
+    segments, members, ref = [], [], None
+    for t, pts in enumerate(landmarks):
+        if pts is None:
+            continue
+        pts = np.asarray(pts, dtype=np.float32)
+        if ref is not None and np.abs(pts[idx] - ref[idx]).mean() > drift_px:
+            segments.append((start, np.median(members, axis=0)))
+            ref, members = None, []
+        if ref is None:
+            ref, start = pts, (t if segments else 0)
+        members.append(pts)
+    if ref is None:
+        raise ValueError("No face landmarks available for the ROI masks")
+    segments.append((start, np.median(members, axis=0)))
+    return segments
+
+
+def roi_weights(points, shape):
+    """
+    ROI ポリゴンを塗りつぶしたマスクを面積で割った重み行列。
+    全 ROI を囲む矩形 (y0:y1, x0:x1) に切り詰め、緑チャンネル (n, h·w) との積1回で全 ROI の平均を求める。
+    return: ((y0, y1, x0, x1), 重み (h·w, R))
+    """
+    h, w = shape
+    masks = np.zeros((len(ROI_POLYGONS), h, w), dtype=np.uint8)
+    for r, (name, poly) in enumerate(ROI_POLYGONS.items()):
+        cv2.fillPoly(masks[r], [np.round(points[poly]).astype(np.int32)], 1)
+        if not masks[r].any():
+            raise ValueError(f"ROI '{name}' is empty for frame size {shape}")
+    ys, xs = np.nonzero(masks.any(axis=0))
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    crop = masks[:, y0:y1, x0:x1].reshape(len(masks), -1).astype(np.float32)
+    weights = (crop / crop.sum(axis=1, keepdims=True)).T
+    return (y0, y1, x0, x1), np.ascontiguousarray(weights)
+
+
+class RoiSampler:
+    """ ランドマークから作った額・頬のマスク平均（マスクは区間ごとに一度だけ作る） """
+    def __init__(self, landmarks, drift_px=3.0):
+        if isinstance(landmarks, str):
+            landmarks = load_landmarks(landmarks)
+        self.segments = roi_segments(landmarks, drift_px)
+        self._starts = np.array([start for start, _ in self.segments])
+        self.n_signals = len(ROI_POLYGONS)
+        self._weights = {}
+
+    def __call__(self, frames, start):
+        """ frames: (n, H, W, 3) → (R, n)。start は先頭フレームの通し番号（区間の選択に使う） """
+        n, h, w = frames.shape[:3]
+        seg = np.searchsorted(self._starts, start + np.arange(n), side='right') - 1
+        out = np.empty((n, self.n_signals), dtype=np.float64)
+        for k in np.unique(seg):
+            if (k, h, w) not in self._weights:
+                self._weights[(k, h, w)] = roi_weights(self.segments[k][1], (h, w))
+            (y0, y1, x0, x1), weights = self._weights[(k, h, w)]
+            sel = np.nonzero(seg == k)[0]
+            sub = frames[sel[0]:sel[-1]+1, y0:y1, x0:x1, GREEN]   # 区間内のフレームは連続している
+            out[sel] = np.asarray(sub, dtype=np.float32).reshape(len(sel), -1) @ weights
+        return out.T
+
+
+class VideoSource:
+    """ 動画ファイルを cv2.VideoCapture で順に読む """
+    def __init__(self, path, chunk=CHUNK_FRAMES):
+        self.name = path
+        self.chunk = chunk
+
+    def __iter__(self):
+        cap = cv2.VideoCapture(self.name)
+        if not cap.isOpened():
+            raise FileNotFoundError(f"Cannot open video: {self.name}")
+        try:
+            frames = []
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frames.append(frame)
+                if len(frames) == self.chunk:
+                    yield np.stack(frames)
+                    frames = []
+            if frames:
+                yield np.stack(frames)
+        finally:
+            cap.release()
+
+
+class PngDirSource:
+    """
+    アライン済みフレーム（*.png）のディレクトリをファイル名順に読む。
+    読めないフレームは直前のフレーム（先頭なら最初に読めたフレーム）で埋め、フレーム i が常に
+    ファイル i（= ランドマークの i 行目）に対応するようにする。
+    """
+    def __init__(self, frame_dir, chunk=CHUNK_FRAMES):
+        self.name = frame_dir
+        self.chunk = chunk
+        self.files = sorted(glob.glob(os.path.join(frame_dir, "*.png")))
+        if not self.files:
+            raise FileNotFoundError(f"No aligned frames found in {frame_dir}")
+
+    def __iter__(self):
+        prev, pending = None, 0   # pending: 最初に読めるフレームより前の読めなかった枚数
+        for start in range(0, len(self.files), self.chunk):
+            frames = []
+            for fn in self.files[start:start+self.chunk]:
+                img = cv2.imread(fn)
+                if img is None:
+                    print(f"Warning: Could not read image {fn}; repeating the previous frame")
+                    if prev is None:
+                        pending += 1
+                        continue
+                    img = prev
+                elif pending:
+                    frames.extend([img] * pending)
+                    pending = 0
+                frames.append(img)
+                prev = img
+            if frames:
+                yield np.stack(frames)
+
+
+class ArraySource:
+    """ (N, H, W, 3) のフレーム配列、または .npy のフレームストア（メモリマップで読む） """
+    def __init__(self, frames, chunk=CHUNK_FRAMES):
+        if isinstance(frames, str):
+            self.name = frames
+            frames = np.load(frames, mmap_mode='r')
+        else:
+            self.name = "<array>"
+        self.frames = frames
+        self.chunk = chunk
+
+    def __iter__(self):
+        for start in range(0, len(self.frames), self.chunk):
+            yield self.frames[start:start+self.chunk]
+
+
+def open_source(path, chunk=CHUNK_FRAMES):
+    """ パスの種類からフレームソースを選ぶ（ディレクトリ → PNG, .npy → フレームストア, それ以外 → 動画） """
+    if os.path.isdir(path):
+        return PngDirSource(path, chunk)
+    if path.endswith(".npy"):
+        return ArraySource(path, chunk)
+    return VideoSource(path, chunk)
+
+
+def iter_signals(source, sampler):
+    """
+    フレームソースを順に読みながら、チャンクごとに sampler で (S, n) の信号を計算して yield する。
+    GridSampler では選択行列との積 rows @ frame @ cols でパッチ和を求める。画素値は 255 以下の
+    整数なので、パッチの画素数が 2^24/255（約 256×256）以下ならパッチ和は float32 でも丸め誤差なく求まる。
+    """
+    shape = None
+    t = 0
+    for frames in source:
+        if shape is None:
+            shape = frames.shape[1:3]
+        elif frames.shape[1:3] != shape:
+            raise ValueError(f"Frame size changed from {shape} to {frames.shape[1:3]} in {source.name}")
+        yield sampler(frames, t)
+        t += len(frames)
+    if shape is None:
+        raise ValueError(f"No frames in {source.name}")
+
+
+def iter_patch_signals(source, patch_size=64, grid_size=4):
+    return iter_signals(source, GridSampler(patch_size, grid_size))
+
+
+def patch_signals(source, patch_size=64, grid_size=4, sampler=None):
+    """ return: (S, N) の信号（グリッドなら S = grid_size², パッチ番号は i*grid_size + j） """
+    sampler = sampler or GridSampler(patch_size, grid_size)
+    return np.concatenate(list(iter_signals(source, sampler)), axis=1)
+
+
+def patch_means(frames, patch_size=64, grid_size=4):
+    """ (N, H, W, 3) のフレーム配列に対する patch_signals """
+    return patch_signals(ArraySource(frames), patch_size, grid_size)
+
+
+def bandpass_coeffs(fs=30, low=0.7, high=4.0, order=4, output='ba'):
+    nyq = 0.5 * fs
+    return butter(order, [low/nyq, high/nyq], btype='band', output=output)
+
+
+def bandpass_signals(signals, fs=30, low=0.7, high=4.0, order=4):
+    """ (P, N) の全パッチ信号に時間方向の filtfilt を一度に適用 """
+    b, a = bandpass_coeffs(fs, low, high, order)
+    return filtfilt(b, a, signals, axis=-1)
+
+
+def correlation_features(filtered):
+    """ (P, N) の信号の相関係数行列の上三角（対角を除く）→ (P*(P-1)/2,) """
+    p = len(filtered)
+    return np.corrcoef(filtered)[np.triu_indices(p, k=1)]
+
+
+def extract_features(source, patch_size=64, grid_size=4, fs=30, sampler=None):
+    """
+    フレームソース（またはフレーム配列 (N, H, W, 3)）から rPPG 特徴ベクトルを計算する。
+    学習（generate_rppg_features.py）と評価（compute_rppg.py）の両方がこれを使う。
+    sampler に RoiSampler を渡すとグリッドの代わりにランドマーク ROI の信号を使う。
+    """
+    if isinstance(source, np.ndarray):
+        source = ArraySource(source)
+    signals = patch_signals(source, patch_size, grid_size, sampler)
+    return correlation_features(bandpass_signals(signals, fs=fs))
+
+
+def extract_segment_features(source, segment, patch_size=64, grid_size=4, fs=30, sampler=None):
+    """
+    フレームソースを segment フレームずつの区間（重なりなし）に分け、区間ごとの特徴ベクトルを返す。
+    信号の抽出は1回だけで、各区間は extract_features をその区間だけに適用したものと同じ。
+    端数の区間は捨てる（全体が segment に満たなければ全体で1区間）。
+    return: (区間数, 特徴次元), 各区間の先頭フレーム番号 (区間数,)
+    """
+    if isinstance(source, np.ndarray):
+        source = ArraySource(source)
+    signals = patch_signals(source, patch_size, grid_size, sampler)
+    n = signals.shape[1]
+    starts = np.arange(0, n - segment + 1, segment) if n >= segment else np.array([0])
+    feats = [correlation_features(bandpass_signals(signals[:, t:t+segment], fs=fs)) for t in starts]
+    return np.stack(feats), starts
+
+
+class WindowedFeatures:
+    """
+    ストリーミング用の窓付き rPPG 特徴量。
+      - 因果的な SOS バンドパス（sosfilt の状態をチャンク間で引き継ぐ）
+      - 直近 window フレームの Σy と Σy·yᵀ を、入るフレームを足し出るフレームを引いて更新
+        （1フレームあたりパッチ対ごとに O(1)）
+      - step フレームごとに、その時点の窓の相関係数の上三角を特徴ベクトルとして出力
+    保持するのは直近 window フレーム分のフィルタ済み信号 (window, P) だけなので、
+    メモリは動画の長さによらない。
+    filtfilt（ゼロ位相）ではなく因果フィルタなので、クリップ全体の特徴量とは完全には一致しない。
+    """
+    def __init__(self, n_patches, window, step, fs=30, low=0.7, high=4.0, order=4):
+        self.window, self.step = window, step
+        self.sos = bandpass_coeffs(fs, low, high, order, output='sos')
+        self.zi = None
+        self.hist = np.zeros((window, n_patches))         # 直近 window フレーム（古い順）
+        self.s1 = np.zeros(n_patches)
+        self.s2 = np.zeros((n_patches, n_patches))
+        self.frames = 0
+        self._since_resync = 0
+        self._triu = np.triu_indices(n_patches, k=1)
+
+    def _filter(self, signals):
+        if self.zi is None:
+            # 最初のサンプルの定常状態から始めて立ち上がりの過渡応答を抑える
+            self.zi = sosfilt_zi(self.sos)[:, None, :] * signals[:, 0][None, :, None]
+        y, self.zi = sosfilt(self.sos, signals, axis=-1, zi=self.zi)
+        return y.T
+
+    def update(self, signals):
+        """
+        signals: 新しい (P, n) のパッチ信号。
+        return: この区間で確定した窓の list [(開始フレーム, 終了フレーム(含まない), 特徴ベクトル)]
+        """
+        y = self._filter(np.asarray(signals, dtype=np.float64))   # (n, P)
+        n = len(y)
+        ys = np.concatenate([self.hist, y])                        # (window + n, P)
+        enter, leave = ys[self.window:], ys[:n]
+        cum1 = self.s1 + np.cumsum(enter - leave, axis=0)
+        cum2 = self.s2 + np.cumsum(enter[:, :, None] * enter[:, None, :]
+                                   - leave[:, :, None] * leave[:, None, :], axis=0)
+        out = []
+        ends = self.frames + 1 + np.arange(n)                      # 各フレームを足した後のフレーム数
+        for k in np.nonzero((ends >= self.window) & ((ends - self.window) % self.step == 0))[0]:
+            out.append((int(ends[k]) - self.window, int(ends[k]), self._features(cum1[k], cum2[k])))
+
+        self.hist = ys[-self.window:]
+        self.frames += n
+        self._since_resync += n
+        if self._since_resync >= self.window:
+            # 足し引きの丸め誤差が溜まらないよう、窓の中身から和を計算し直す
+            self.s1, self.s2 = self.hist.sum(axis=0), self.hist.T @ self.hist
+            self._since_resync = 0
+        else:
+            self.s1, self.s2 = cum1[-1], cum2[-1]
+        return out
+
+    def _features(self, s1, s2):
+        mean = s1 / self.window
+        cov = s2 / self.window - np.outer(mean, mean)
+        std = np.sqrt(np.clip(np.diag(cov), 0.0, None))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.outer(std, std)
+        return corr[self._triu]
+
+
+def iter_window_features(source, window, step, patch_size=64, grid_size=4, fs=30, sampler=None):
+    """ フレームソースから (開始フレーム, 終了フレーム, 特徴ベクトル) を窓ごとに yield する """
+    sampler = sampler or GridSampler(patch_size, grid_size)
+    engine = WindowedFeatures(sampler.n_signals, window, step, fs=fs)
+    for signals in iter_signals(source, sampler):
+        yield from engine.update(signals)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# rppg_model.py
+"""
+rPPG Realness Score 用ロジスティック回帰モデルの保存形式。
+
+sklearn の LogisticRegression を pickle する代わりに、
+  - 係数 (coef)・切片 (intercept)・クラス (classes)
+  - 学習に使った特徴量の設定（patch_size / grid_size / fps / roi / feature_version）
+だけを rppg_model.json に書き出す。読み込みは JSON をパースするだけで sklearn も不要。
+predict_proba は特徴量行列 (N, F) に対する1回の行列積で全サンプルを評価する。
+
+Usage（旧形式 rppg_model.pkl からの移行）:
+    python training/rppg_model.py --from-pkl rppg_model.pkl --out rppg_model.json
+"""
+
+import argparse
+import json
+import pickle
+import time
+
+import numpy as np
+
+from rppg_features import FEATURE_VERSION
+
+MODEL_PATH = "rppg_model.json"
+MODEL_VERSION = 1
+DEFAULT_CONFIG = {"patch_size": 64, "grid_size": 4, "fps": 30, "roi": False, "feature_version": FEATURE_VERSION}
+
+
+class RppgModel:
+    """ 2クラスのロジスティック回帰（sklearn の predict_proba と同じ値を返す） """
+    def __init__(self, coef, intercept, classes=(0, 1), config=None):
+        self.coef = np.asarray(coef, dtype=np.float64).reshape(-1)
+        self.intercept = float(np.asarray(intercept).reshape(-1)[0])
+        self.classes = [int(c) for c in classes]
+        if len(self.classes) != 2:
+            raise ValueError(f"Only binary models are supported (classes={self.classes})")
+        self.config = {**DEFAULT_CONFIG, **(config or {})}
+
+    @property
+    def n_features_in_(self):
+        return len(self.coef)
+
+    @classmethod
+    def from_sklearn(cls, model, config=None):
+        return cls(model.coef_, model.intercept_, model.classes_, config)
+
+    def decision_function(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.coef + self.intercept
+
+    def predict_proba(self, X):
+        """ X: (N, F) → (N, 2)。列の並びは classes と同じ """
+        p1 = 1.0 / (1.0 + np.exp(-self.decision_function(X)))
+        return np.stack([1.0 - p1, p1], axis=1)
+
+    def p_real(self, X):
+        """ X: (N, F) → 実写クラス (label 1) の確率 (N,) """
+        return self.predict_proba(X)[:, self.classes.index(1)]
+
+
+def save_model(model, path=MODEL_PATH):
+    with open(path, "w") as f:
+        json.dump({
+            "version": MODEL_VERSION,
+            "config": model.config,
+            "classes": model.classes,
+            "intercept": model.intercept,
+            "coef": model.coef.tolist(),
+        }, f, indent=2)
+
+
+def load_model(path=MODEL_PATH):
+    """ rppg_model.json を読み込む（旧形式の .pkl も読めるが、特徴量の設定はデフォルト扱い） """
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            return RppgModel.from_sklearn(pickle.load(f))
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("version") != MODEL_VERSION:
+        raise ValueError(f"Unsupported rPPG model version: {data.get('version')}")
+    model = RppgModel(data["coef"], data["intercept"], data["classes"], data["config"])
+    # 特徴量の定義が変わったモデルは現在のエンジンの特徴量と対応しない
+    if model.config["feature_version"] != FEATURE_VERSION:
+        raise ValueError(f"{path} was trained on rPPG feature version {model.config['feature_version']}, "
+                         f"but the feature engine is version {FEATURE_VERSION}; retrain the model")
+    return model
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Convert a pickled rppg_model.pkl into rppg_model.json")
+    ap.add_argument("--from-pkl", default="rppg_model.pkl", help="Pickled LogisticRegression")
+    ap.add_argument("--out", default=MODEL_PATH, help="Output model JSON")
+    ap.add_argument("--manifest", default=None,
+                    help="X_train.manifest.json of the training data (feature settings are taken from it)")
+    args = ap.parse_args()
+
+    config = None
+    if args.manifest:
+        with open(args.manifest) as f:
+            config = json.load(f)["params"]
+    with open(args.from_pkl, "rb") as f:
+        model = RppgModel.from_sklearn(pickle.load(f), config)
+    save_model(model, args.out)
+    t0 = time.perf_counter()
+    load_model(args.out)
+    print(f"[rPPG] Wrote {args.out}: {model.n_features_in_} features  config={model.config}  "
+          f"load {(time.perf_counter()-t0)*1e6:.0f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,162 @@
 # training/train_detectors.py
+"""
+XceptionPP（299×299）と ViTDetector（224×224）を frames/aligned/{gen,real} でファインチューニングする。
+
+フレームは training/frame_cache.py のキャッシュ（デコード済み uint8 の memmap）から読み、
+リサイズ・正規化は SharedPreprocessor でバッチ単位に行う（エポックごとの PNG デコードは無い）。
+
+既定では2モデルを1本のバッチストリームから同時に学習する（読み込み・前処理は1回、GPU では各ステップも並列）。
+--sequential で従来どおり1モデルずつ学習する。モデルの初期化は検出器ごとに seed + 番号 で行うので、
+同じ --seed なら同時学習と --sequential の初期重み・バッチ順は一致する。
+
+Usage:
+    python training/train_detectors.py [--root frames/aligned] [--epochs 5] [--workers 4] [--sequential]
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
-import pickle
 import torch
 from torch import nn, optim
-from torchvision import datasets, transforms
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from detectors import XceptionPP, ViTDetector, MEAN, STD, DEVICE
+from detectors import XceptionPP, ViTDetector, SharedPreprocessor, DEVICE
+from detector_registry import save_registry, REGISTRY_PATH
+from frame_cache import build_frame_cache, FrameCacheDataset, make_loader, CACHE_ENV
+
+class _Trainee:
+    """ 同時に学習する検出器1つ分の状態（モデル・最適化器・計測値） """
+    def __init__(self, detector_cls, input_size, init_seed):
+        self.name = detector_cls.__name__
+        self.input_size = input_size
+        # 分類ヘッドの初期値が他のモデルの構築順に依存しないよう、モデルごとにシードを固定してから作る
+        torch.manual_seed(init_seed)
+        self.detector = detector_cls(pretrained=True)
+        self.model = self.detector.model.to(DEVICE)
+        self.criterion = nn.BCEWithLogitsLoss()
+        self.optimizer = optim.Adam(self.model.parameters(), lr=1e-4)
+        # GPU では検出器ごとに別ストリームで実行し、2モデルの計算を重ねる
+        self.stream = torch.cuda.Stream() if DEVICE.type == "cuda" else None
+        self.running_loss = 0.0
+        self.busy_s = 0.0
+        self.last_loss = float("nan")
+
+    def step(self, imgs, labels):
+        t0 = time.perf_counter()
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            if self.stream is not None:
+                self.stream.wait_stream(torch.cuda.default_stream())
+            self.optimizer.zero_grad()
+            loss = self.criterion(self.model(imgs), labels)
+            loss.backward()
+            self.optimizer.step()
+            self.last_loss = loss.item()
+        self.running_loss += self.last_loss * imgs.size(0)
+        self.busy_s += time.perf_counter() - t0
 
-def train_detector(detector_cls, input_size, epochs=5, batch_size=16):
-    """ detector_cls（XceptionPP または ViTDetector）を input_size で学習 """
-    print(f"=== Training {detector_cls.__name__} (input {input_size}×{input_size}) ===")
+
+def train_detectors(specs, dataset, epochs=5, batch_size=16, workers=4, seed=0, init_seeds=None):
+    """
+    specs: [(detector_cls, input_size), ...] を1本のバッチストリームで同時に学習する。
+    各バッチは一度だけ読み込み、同じ uint8 バッチから全入力サイズを作る。
+    GPU で検出器が複数あれば各ステップをスレッド・ストリームで並列に実行する（演算中は GIL が解放される）。
+    CPU では各モデルの演算が既に全コアを使うので、ステップは順番に実行する（スレッドを重ねると過剰購読になる）。
+    init_seeds: モデル初期化のシード（デフォルト: seed + specs での番号）
+    return: 学習済み検出器の list（specs と同じ順）
+    """
+    names = ", ".join(f"{cls.__name__} ({size}×{size})" for cls, size in specs)
+    print(f"=== Training {names} ===")
 
     # モデルと最適化器のセットアップ
-    detector = detector_cls(pretrained=True)
-    model = detector.model.to(DEVICE)
-    criterion = nn.BCEWithLogitsLoss()
-    optimizer = optim.Adam(model.parameters(), lr=1e-4)
-
-    # モデル固有の前処理
-    transform = transforms.Compose([
-        transforms.Resize(input_size),
-        transforms.CenterCrop(input_size),
-        transforms.ToTensor(),
-        transforms.Normalize(MEAN, STD),
-    ])
-
-    # データローダー
-    dataset = datasets.ImageFolder(root="frames/aligned/", transform=transform)
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+    init_seeds = init_seeds or [seed + i for i in range(len(specs))]
+    trainees = [_Trainee(cls, size, s) for (cls, size), s in zip(specs, init_seeds)]
+    tag = "+".join(t.name for t in trainees)
+
+    # 全検出器の前処理（Resize → CenterCrop → Normalize をバッチ単位で、デコード済み uint8 から1回だけ）
+    pre = SharedPreprocessor([t.input_size for t in trainees])
+
+    # データローダー（ワーカーは memmap からスライスするだけ、エポック間で使い回す）
+    loader, sampler = make_loader(dataset, batch_size, seed=seed, workers=workers)
+    parallel = len(trainees) > 1 and DEVICE.type == "cuda"
+    pool = ThreadPoolExecutor(max_workers=len(trainees)) if parallel else None
 
     # 学習ループ（tqdmでバッチごとの進捗表示）
     for epoch in range(1, epochs + 1):
-        model.train()
-        running_loss = 0.0
-        progress_bar = tqdm(
-            loader,
-            desc=f"[{detector_cls.__name__}] Epoch {epoch}/{epochs}",
-            unit="batch"
-        )
-        for imgs, labels in progress_bar:
-            imgs   = imgs.to(DEVICE)
+        for t in trainees:
+            t.model.train()
+            t.running_loss = t.busy_s = 0.0
+        sampler.set_epoch(epoch)
+        wait_s = 0.0
+        t_epoch = time.perf_counter()
+        progress_bar = tqdm(loader, desc=f"[{tag}] Epoch {epoch}/{epochs}", unit="batch")
+        t_wait = time.perf_counter()
+        for frames, labels, _ in progress_bar:
+            wait_s += time.perf_counter() - t_wait
+            inputs = pre(frames.numpy(), prepared=True)
             labels = labels.float().unsqueeze(1).to(DEVICE)
 
-            optimizer.zero_grad()
-            logits = model(imgs)
-            loss   = criterion(logits, labels)
-            loss.backward()
-            optimizer.step()
+            # 出力バッファは次の pre() で上書きされるので、全検出器のステップが終わるまで待つ
+            if pool is None:
+                for t in trainees:
+                    t.step(inputs[t.input_size], labels)
+            else:
+                for fut in [pool.submit(t.step, inputs[t.input_size], labels) for t in trainees]:
+                    fut.result()
 
-            running_loss += loss.item() * imgs.size(0)
-            progress_bar.set_postfix({"loss": f"{loss.item():.4f}"})
+            progress_bar.set_postfix({t.name: f"{t.last_loss:.4f}" for t in trainees})
+            t_wait = time.perf_counter()
 
-        avg_loss = running_loss / len(dataset)
-        print(f"[{detector_cls.__name__}] Epoch {epoch}/{epochs} completed. Avg loss: {avg_loss:.4f}")
+        wall = time.perf_counter() - t_epoch
+        for t in trainees:
+            print(f"[{t.name}] Epoch {epoch}/{epochs} completed. Avg loss: {t.running_loss/len(dataset):.4f}  "
+                  f"step {len(dataset)/max(t.busy_s, 1e-9):.1f} frames/s")
+        print(f"[{tag}] Epoch {epoch}/{epochs}: {wall:.1f}s ({len(dataset)/wall:.1f} frames/s, "
+              f"waiting for data {wait_s/wall*100:.0f}%)")
+    if pool is not None:
+        pool.shutdown()
 
     # 学習済み重みをラッパーに反映して返す
-    detector.model.load_state_dict(model.state_dict())
-    return detector
+    for t in trainees:
+        t.detector.model.load_state_dict(t.model.state_dict())
+    return [t.detector for t in trainees]
+
+def train_detector(detector_cls, input_size, dataset, epochs=5, batch_size=16, workers=4, seed=0, init_seed=None):
+    """ detector_cls（XceptionPP または ViTDetector）を input_size で学習（dataset は FrameCacheDataset） """
+    init_seeds = None if init_seed is None else [init_seed]
+    return train_detectors([(detector_cls, input_size)], dataset, epochs, batch_size, workers, seed, init_seeds)[0]
 
 if __name__ == '__main__':
-    # XceptionPP を 299×299 で学習
-    det_x = train_detector(XceptionPP, input_size=299, epochs=5)
+    parser = argparse.ArgumentParser(description="Fine-tune XceptionPP and ViTDetector on aligned frames")
+    parser.add_argument('--root', default="frames/aligned/", help='ImageFolder 形式のフレーム（real/, gen/）')
+    parser.add_argument('--cache-dir', default=None, help=f'フレームキャッシュ（デフォルト: ${CACHE_ENV} または ~/.cache）')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='DataLoader のワーカー数')
+    parser.add_argument('--seed', type=int, default=0, help='シャッフル順のシード')
+    parser.add_argument('--sequential', action='store_true',
+                        help='2モデルを同時に学習せず、従来どおり1モデルずつ学習する')
+    args = parser.parse_args()
+
+    # フレームを一度だけデコードしてキャッシュ（2回目以降はキャッシュを開くだけ）
+    dataset = FrameCacheDataset(build_frame_cache(args.root, args.cache_dir))
+    print(f"[Train] {len(dataset)} frames {dataset.classes}")
 
-    # ViTDetector を 224×224 で学習
-    det_v = train_detector(ViTDetector, input_size=224, epochs=5)
+    # XceptionPP を 299×299、ViTDetector を 224×224 で学習
+    specs = [(XceptionPP, 299), (ViTDetector, 224)]
+    t0 = time.perf_counter()
+    if args.sequential:
+        # 初期化のシードは同時学習と同じ seed + 番号
+        detectors = [train_detector(cls, size, dataset, args.epochs, args.batch_size, args.workers, args.seed,
+                                    init_seed=args.seed + i)
+                     for i, (cls, size) in enumerate(specs)]
+    else:
+        # 1本のバッチストリームから両モデルを同時に学習
+        detectors = train_detectors(specs, dataset, args.epochs, args.batch_size, args.workers, args.seed)
+    print(f"[Train] Total training time: {time.perf_counter()-t0:.1f}s")
 
-    # 学習済検出器を保存
-    with open('detectors.pkl', 'wb') as f:
-        pickle.dump([det_x, det_v], f)
-    print("ファインチューニング済みモデルを detectors.pkl に保存しました。")
+    # 学習済検出器を保存（重みはキャッシュ、構成は detectors.json）
+    save_registry(detectors, REGISTRY_PATH)
+    print(f"ファインチューニング済みモデルを {REGISTRY_PATH} に保存しました。")